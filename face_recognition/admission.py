@@ -0,0 +1,279 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+# Admission control configuration
+USE_ADMISSION_CONTROL = os.getenv("USE_ADMISSION_CONTROL", "false").lower() == "true"
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "4"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_BULK_MAX_QUEUE = int(os.getenv("ADMISSION_BULK_MAX_QUEUE", "8"))
+# Default budget when the caller sends no deadline; below the 30s proxy timeout
+ADMISSION_DEFAULT_DEADLINE_MS = int(os.getenv("ADMISSION_DEFAULT_DEADLINE_MS", "25000"))
+DEADLINE_HEADER = "x-request-deadline-ms"
+
+# Priority lanes, lower value is served first
+INTERACTIVE = 0
+BULK = 1
+LANE_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Paths subject to admission control and their lanes
+ROUTE_LANES = {
+    "/recognize-face": INTERACTIVE,
+    "/register-face": BULK,
+}
+
+
+
+class _Deadline:
+    """A request's absolute deadline; a write in progress is exempt from it"""
+
+    __slots__ = ("at", "writing")
+
+    def __init__(self, at: float):
+        self.at = at
+        self.writing = False
+
+
+_deadline: contextvars.ContextVar[Optional[_Deadline]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def check_deadline() -> None:
+    """
+    Abort the current request if its deadline has passed
+
+    Call between expensive stages so abandoned requests stop doing work.
+    """
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() >= deadline.at:
+        raise HTTPException(status_code=503, detail="Request deadline exceeded")
+
+
+def begin_write() -> None:
+    """
+    Check the deadline one last time, then exempt the request from it
+
+    Call right before a write that takes several round trips. Once a
+    handler gets here the middleware lets it finish instead of cancelling
+    it halfway, so a stored face is always stamped, versioned and published
+    and the caller gets its ID rather than a 503 it would retry.
+    """
+    check_deadline()
+    deadline = _deadline.get()
+    if deadline is not None:
+        deadline.writing = True
+
+
+def remaining_seconds() -> Optional[float]:
+    """Time left before the current request's deadline, if it has one"""
+    deadline = _deadline.get()
+    return None if deadline is None else max(0.0, deadline.at - time.monotonic())
+
+
+class AdmissionController:
+    """
+    Bounded in-flight limit with per-lane wait queues
+
+    At most max_in_flight requests run at once. Others wait in a priority
+    queue, interactive before bulk and FIFO within a lane, until a slot frees
+    up or their deadline passes. A request whose lane queue is full is
+    rejected immediately instead of queueing.
+    """
+
+    def __init__(self, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+                 max_queue: Optional[Dict[int, int]] = None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max_queue or {INTERACTIVE: ADMISSION_MAX_QUEUE, BULK: ADMISSION_BULK_MAX_QUEUE}
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._queued = {lane: 0 for lane in self.max_queue}
+        self._sequence = itertools.count()
+        self._counters = {
+            lane: {"admitted": 0, "rejected_queue_full": 0, "expired_in_queue": 0, "expired_in_flight": 0}
+            for lane in self.max_queue
+        }
+
+    async def acquire(self, lane: int, deadline: float) -> None:
+        """
+        Wait for an in-flight slot
+
+        Raises:
+            AdmissionRejected: 429 if the lane queue is full, 503 if the
+            deadline passes while queued
+        """
+        counters = self._counters[lane]
+        if self.in_flight < self.max_in_flight and not self._queued_total():
+            self.in_flight += 1
+            counters["admitted"] += 1
+            return
+
+        if self._queued[lane] >= self.max_queue[lane]:
+            counters["rejected_queue_full"] += 1
+            raise AdmissionRejected(429, "Server busy, retry later")
+
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            counters["expired_in_queue"] += 1
+            raise AdmissionRejected(503, "Request deadline exceeded before processing")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._sequence), future))
+        self._queued[lane] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if future.done():
+                # Granted a slot just as the deadline hit; hand it back
+                self.release()
+            else:
+                future.cancel()
+                self._queued[lane] -= 1
+            counters["expired_in_queue"] += 1
+            raise AdmissionRejected(503, "Request deadline exceeded while queued")
+        except asyncio.CancelledError:
+            if future.done():
+                self.release()
+            else:
+                future.cancel()
+                self._queued[lane] -= 1
+            raise
+        counters["admitted"] += 1
+
+    def release(self) -> None:
+        """Free a slot, handing it straight to the highest-priority waiter"""
+        while self._waiters:
+            lane, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Abandoned waiter, already removed from the lane count
+                continue
+            self._queued[lane] -= 1
+            future.set_result(None)
+            return
+        self.in_flight -= 1
+
+    def _queued_total(self) -> int:
+        return sum(self._queued.values())
+
+    def record_expired(self, lane: int) -> None:
+        self._counters[lane]["expired_in_flight"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "lanes": {
+                LANE_NAMES.get(lane, str(lane)): {
+                    "queued": self._queued[lane],
+                    "max_queue": self.max_queue[lane],
+                    **self._counters[lane],
+                }
+                for lane in self.max_queue
+            },
+        }
+
+
+def _request_deadline(scope: Dict[str, Any]) -> float:
+    """Absolute deadline from the caller's budget header, or the default budget"""
+    budget_ms = ADMISSION_DEFAULT_DEADLINE_MS
+    for key, value in scope.get("headers", []):
+        if key.decode("latin-1").lower() == DEADLINE_HEADER:
+            try:
+                budget_ms = min(int(value), budget_ms) if value else budget_ms
+            except ValueError:
+                pass
+            break
+    return time.monotonic() + budget_ms / 1000
+
+
+async def _send_json(send, status_code: int, detail: str, headers: Optional[List[Tuple[bytes, bytes]]] = None) -> None:
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())] + (headers or []),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying admission control to ROUTE_LANES paths
+
+    The request deadline is exposed through check_deadline() while the
+    handler runs, and the handler is cancelled at its next await once the
+    deadline passes, so work for a caller that already gave up stops early.
+    Handlers past begin_write() are left to finish.
+    """
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None,
+                 lanes: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.controller = controller or admission_controller
+        self.lanes = lanes or ROUTE_LANES
+
+    async def __call__(self, scope, receive, send):
+        lane = self.lanes.get(scope.get("path")) if scope["type"] == "http" else None
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+
+        deadline = _request_deadline(scope)
+        try:
+            await self.controller.acquire(lane, deadline)
+        except AdmissionRejected as e:
+            headers = [(b"retry-after", b"1")] if e.status_code == 429 else None
+            await _send_json(send, e.status_code, e.detail, headers)
+            return
+
+        response_started = False
+
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        request_deadline = _Deadline(deadline)
+        token = _deadline.set(request_deadline)
+        # The handler task copies the context, so it sees request_deadline
+        handler = asyncio.ensure_future(self.app(scope, receive, send_wrapper))
+        try:
+            await asyncio.wait_for(asyncio.shield(handler), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            if request_deadline.writing:
+                await handler
+            else:
+                handler.cancel()
+                try:
+                    await handler
+                except asyncio.CancelledError:
+                    pass
+                self.controller.record_expired(lane)
+                if not response_started:
+                    await _send_json(send, 503, "Request deadline exceeded")
+        except asyncio.CancelledError:
+            if not request_deadline.writing:
+                handler.cancel()
+            raise
+        finally:
+            _deadline.reset(token)
+            self.controller.release()
+
+
+admission_controller = AdmissionController()
@@ -1,5 +1,7 @@
 from fastapi import FastAPI, HTTPException, Form, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import time
 import numpy as np
 import base64
 from typing import Dict, Any, Optional, List
@@ -18,6 +20,37 @@ from face_utils import (
 
 # Import database module
 import db
+from result_cache import MATCH_CACHE_TTL_SECONDS, content_digest, feature_cache, match_cache
+import projection
+from matching import (
+    USE_CASCADE,
+    cascade_matcher,
+    coarse_features,
+    normalized_matrix,
+    select_top_k,
+    select_top_k_pairs,
+    top_k_matches
+)
+from gallery_snapshot import (
+    USE_GALLERY_SNAPSHOT,
+    SNAPSHOT_REBUILD_SECONDS,
+    PendingFaces,
+    SnapshotReader,
+    rebuild_from_db
+)
+from sharding import USE_SHARDED_GALLERY, sharded_gallery
+from gallery_cache import USE_GALLERY_CACHE, GalleryCache
+from quantized import USE_QUANTIZED_GALLERY, QuantizedIndex, quantized_fields
+from admission import USE_ADMISSION_CONTROL, AdmissionMiddleware, admission_controller, begin_write, check_deadline
+from profiling import USE_PROFILING, ProfilingMiddleware
+from identity import (
+    USE_IDENTITY_MATCHING,
+    MAX_TEMPLATES_PER_IDENTITY,
+    TEMPLATE_REDUNDANT_SIMILARITY,
+    IdentityGallery,
+    centroid_fields,
+    identity_of
+)
 
 # Custom JSON encoder for ObjectId
 class CustomJSONEncoder(JSONEncoder):
@@ -44,9 +77,132 @@ class PyObjectId(str):
 
 app = FastAPI(title="Face Recognition API")
 
+# Each matching mode replaces the default gallery search and they are not
+# combined, so enabling several would silently ignore all but one
+_matching_modes = [
+    name for name, enabled in (
+        ("USE_GALLERY_SNAPSHOT", USE_GALLERY_SNAPSHOT),
+        ("USE_SHARDED_GALLERY", USE_SHARDED_GALLERY),
+        ("USE_PROJECTION", projection.USE_PROJECTION),
+        ("USE_QUANTIZED_GALLERY", USE_QUANTIZED_GALLERY),
+        ("USE_CASCADE", USE_CASCADE),
+        ("USE_IDENTITY_MATCHING", USE_IDENTITY_MATCHING),
+    ) if enabled
+]
+if len(_matching_modes) > 1:
+    raise RuntimeError(
+        f"Matching modes cannot be combined, but {', '.join(_matching_modes)} are enabled; keep one of them"
+    )
+
+# Optional compact-vector projection, fitted offline with `python projection.py fit`
+projection_model = projection.load_latest() if projection.USE_PROJECTION else None
+
+# Memory-mapped gallery shared by all workers, rebuilt after registrations
+snapshot_reader = SnapshotReader() if USE_GALLERY_SNAPSHOT else None
+# This worker's registrations not yet in the snapshot, matched alongside it
+pending_faces = PendingFaces()
+_snapshot_rebuild = {"running": False, "dirty": False, "finished_at": 0.0}
+_background_tasks = set()
+
+async def _rebuild_snapshot():
+    """Rebuild the snapshot at most every SNAPSHOT_REBUILD_SECONDS, batching registrations"""
+    _snapshot_rebuild["dirty"] = True
+    if _snapshot_rebuild["running"]:
+        return
+    _snapshot_rebuild["running"] = True
+    try:
+        while _snapshot_rebuild["dirty"]:
+            due = _snapshot_rebuild["finished_at"] + SNAPSHOT_REBUILD_SECONDS
+            await asyncio.sleep(max(0.0, due - time.monotonic()))
+            _snapshot_rebuild["dirty"] = False
+            # Skipped when another worker's rebuild already covers these faces
+            await rebuild_from_db(covering=pending_faces.latest)
+            _snapshot_rebuild["finished_at"] = time.monotonic()
+    finally:
+        _snapshot_rebuild["running"] = False
+
+def _snapshot_record(snapshot, pending: List[Dict[str, Any]], index: int) -> Dict[str, Any]:
+    """Snapshot face, or a pending face for indices past the end of the snapshot"""
+    return snapshot.record(index) if index < len(snapshot) else pending[index - len(snapshot)]
+
+# Long-lived uint8 gallery that never loads float encodings
+quantized_index = QuantizedIndex() if USE_QUANTIZED_GALLERY else None
+
+def _run_in_background(task: Optional[asyncio.Task]) -> None:
+    """Keep a reference to a background task until it finishes"""
+    if task is None:
+        return
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+# Local persistent copy of the gallery, synced incrementally from Mongo
+gallery_cache = GalleryCache() if USE_GALLERY_CACHE else None
+
+async def _gallery_faces() -> List[Dict[str, Any]]:
+    """Gallery documents for matching, served from the local cache when enabled"""
+    if gallery_cache is None:
+        return await db.find_all_faces_for_comparison()
+    changes = await gallery_cache.maybe_sync(db.face_collection, db.tombstone_collection)
+    if changes and (changes["upserted"] or changes["deleted"]):
+        # Cached match results were computed without these changes
+        db.bump_gallery_version()
+    return gallery_cache.faces()
+
+# Identity-grouped gallery, reused until the gallery version changes
+_identity_gallery = {"version": None, "built_at": 0.0, "gallery": None}
+
+async def _get_identity_gallery(gallery_version: tuple) -> IdentityGallery:
+    """
+    Identity gallery for matching, rebuilt only after the gallery changes
+
+    Writes made outside db.py leave the version unchanged, so the gallery
+    is also rebuilt once it is older than MATCH_CACHE_TTL_SECONDS.
+    """
+    faces = None
+    if gallery_cache is not None:
+        # Syncing may bump the local version
+        faces = await _gallery_faces()
+        gallery_version = (gallery_version[0], db.gallery_version)
+    cached = _identity_gallery
+    age = time.monotonic() - cached["built_at"]
+    if cached["gallery"] is not None and cached["version"] == gallery_version \
+            and not (MATCH_CACHE_TTL_SECONDS and age >= MATCH_CACHE_TTL_SECONDS):
+        return cached["gallery"]
+    if faces is None:
+        faces = await db.find_all_faces_for_comparison()
+    gallery = IdentityGallery(faces)
+    cached.update(version=gallery_version, built_at=time.monotonic(), gallery=gallery)
+    return gallery
+
 @app.on_event("startup")
 async def startup_db_client():
     await db.create_indices()
+    if gallery_cache is not None:
+        await db.stamp_unsynced()
+        await gallery_cache.sync(db.face_collection, db.tombstone_collection)
+        db.bump_gallery_version()
+    if snapshot_reader is not None and snapshot_reader.get() is None:
+        # Workers starting together build the first snapshot once
+        await rebuild_from_db(if_missing=True)
+        _snapshot_rebuild["finished_at"] = time.monotonic()
+    if sharded_gallery is not None:
+        sharded_gallery.start()
+        await sharded_gallery.load_from_db()
+    if quantized_index is not None:
+        await quantized_index.load()
+
+@app.on_event("shutdown")
+async def shutdown_shards():
+    if sharded_gallery is not None:
+        sharded_gallery.stop()
+
+# Bounded in-flight work with deadlines; recognition is admitted before registration
+if USE_ADMISSION_CONTROL:
+    app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+
+# Opt-in sampling profiler for requests sent with the X-Profile token or sampled by rate
+if USE_PROFILING:
+    app.add_middleware(ProfilingMiddleware)
 
 # Configure CORS middleware
 app.add_middleware(
@@ -57,12 +213,92 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+def _add_derived_fields(face_document: Dict[str, Any], encoding: List[float]) -> None:
+    """Store the encodings the enabled matching modes reuse at query time"""
+    if projection_model is not None:
+        face_document["compact_encoding"] = projection_model.transform([encoding])[0].tolist()
+        face_document["projection_version"] = projection_model.version
+    if USE_QUANTIZED_GALLERY:
+        face_document.update(quantized_fields(encoding))
+    if USE_CASCADE:
+        face_document["coarse_encoding"] = coarse_features([encoding], cascade_matcher.pool)[0].tolist()
+
+async def _publish_face(face_document: Dict[str, Any], face_id: str) -> None:
+    """Propagate a newly stored face to the local gallery copies"""
+    if gallery_cache is not None:
+        gallery_cache.upsert([face_document])
+    if snapshot_reader is not None:
+        # Every write up to this counter value, this one included, is in Mongo
+        gallery_counter, _ = await db.current_gallery_version()
+        pending_faces.add({
+            "_id": face_id,
+            "name": face_document["name"],
+            "face_encoding": face_document["face_encoding"],
+            "registration_timestamp": face_document["registration_timestamp"]
+        }, gallery_counter)
+        _run_in_background(asyncio.create_task(_rebuild_snapshot()))
+    if quantized_index is not None:
+        quantized_index.add([{**face_document, "_id": face_id}])
+    if sharded_gallery is not None:
+        face_document["_id"] = face_id
+        await asyncio.get_running_loop().run_in_executor(
+            None, sharded_gallery.insert, [face_document]
+        )
+
+async def _enroll_template(identity_id: str, name: str, face_img, encoding: List[float],
+                           additional_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Add a photo as another template of an existing identity"""
+    templates = await db.find_identity_templates(identity_id)
+    if not templates:
+        raise HTTPException(status_code=404, detail="Identity not found")
+    # Any template's ID names the identity; enroll against its root
+    identity_id = next(
+        (identity_of(template) for template in templates if template.get("identity_id")), identity_id
+    )
+    if len(templates) >= MAX_TEMPLATES_PER_IDENTITY:
+        raise HTTPException(status_code=409, detail=f"Identity already has {len(templates)} templates")
+
+    # Skip photos that add no variation over the templates already enrolled
+    similarities = [compare_face_encodings(template["face_encoding"], encoding) for template in templates]
+    best = int(np.argmax(similarities))
+    if similarities[best] >= TEMPLATE_REDUNDANT_SIMILARITY:
+        return {
+            "id": str(templates[best]["_id"]),
+            "name": templates[best]["name"],
+            "identity_id": identity_id,
+            "message": "An almost identical template is already enrolled for this identity",
+            "timestamp": datetime.now().isoformat(),
+            "is_duplicate": True,
+            "similarity": similarities[best]
+        }
+
+    face_document = create_face_document(name, face_img, encoding, additional_info)
+    face_document["identity_id"] = identity_id
+    _add_derived_fields(face_document, encoding)
+    begin_write()
+    face_id = await db.insert_face(face_document)
+    await db.set_identity_centroid(
+        identity_id, centroid_fields([template["face_encoding"] for template in templates] + [encoding])
+    )
+    await _publish_face(face_document, face_id)
+
+    return {
+        "id": face_id,
+        "name": name,
+        "identity_id": identity_id,
+        "template_count": len(templates) + 1,
+        "message": "Template added to identity",
+        "timestamp": datetime.now().isoformat(),
+        "is_duplicate": False
+    }
+
 @app.post("/register-face")
 async def process_face(
     name: str = Form(...),
     image: UploadFile = File(...),
     additional_info: Optional[str] = Form(None),
-    similarity_threshold: Optional[float] = Form(0.8)
+    similarity_threshold: Optional[float] = Form(0.8),
+    identity_id: Optional[str] = Form(None)
 ):
     """
     Process a face: recognize, encode, and save to database if unique
@@ -71,6 +307,7 @@ async def process_face(
     - **image**: Image file containing a face
     - **additional_info**: Any additional information about the person as JSON string
     - **similarity_threshold**: Threshold for face similarity (0.0 to 1.0, higher is more strict)
+    - **identity_id**: Enroll the photo as another template of this existing identity
     
     Returns:
         - Face ID
@@ -113,18 +350,54 @@ async def process_face(
         
         # Extract face encoding
         new_face_encoding = extract_face_encoding(face_img)
+        check_deadline()
         
-        # Check for duplicate faces
-        all_faces = await db.find_all_faces_for_comparison()
+        if identity_id:
+            return await _enroll_template(identity_id, name, face_img, new_face_encoding, additional_info_dict)
         
         # Look for similar faces
         duplicate_face = None
         highest_similarity = 0.0
         
-        for face in all_faces:
-            known_face_encoding = face["face_encoding"]
-            similarity = compare_face_encodings(known_face_encoding, new_face_encoding)
-            
+        snapshot = snapshot_reader.get() if snapshot_reader is not None else None
+        
+        # Check for duplicate faces; the snapshot, shards or quantized index replace the gallery fetch
+        match_index = sharded_gallery if sharded_gallery is not None else quantized_index
+        if snapshot is not None:
+            all_faces = pending_faces.since(snapshot)
+        elif match_index is not None:
+            all_faces = []
+        else:
+            all_faces = await _gallery_faces()
+        
+        if snapshot is not None:
+            # Only the best snapshot match can be the reported duplicate; faces
+            # registered here since the snapshot was built are checked too
+            scores = snapshot.scores(new_face_encoding)
+            scored = [(int(np.argmax(scores)), float(scores.max()))] if len(scores) else []
+            scored += [
+                (len(snapshot) + index, compare_face_encodings(face["face_encoding"], new_face_encoding))
+                for index, face in enumerate(all_faces)
+            ]
+        elif match_index is not None:
+            # Best match across all shards, or in the quantized index
+            best = (await match_index.asearch([new_face_encoding], 1))[0]
+            all_faces = [{"_id": match["id"], "name": match["name"]} for match in best]
+            scored = [(0, best[0]["similarity"])] if best else []
+        elif USE_CASCADE:
+            # Only faces surviving the coarse pass get an exact comparison
+            scored = cascade_matcher.match(
+                new_face_encoding, all_faces, cascade_matcher.gallery_features(all_faces),
+                similarity_threshold, first_only=True
+            )
+        else:
+            scored = (
+                (index, compare_face_encodings(face["face_encoding"], new_face_encoding))
+                for index, face in enumerate(all_faces)
+            )
+        
+        for index, similarity in scored:
+            face = _snapshot_record(snapshot, all_faces, index) if snapshot is not None else all_faces[index]
             if similarity > highest_similarity:
                 highest_similarity = similarity
                 
@@ -133,6 +406,7 @@ async def process_face(
                 break
         
         # If a duplicate face is found, return information about it
+        check_deadline()
         if duplicate_face:
             return {
                 "id": str(duplicate_face["_id"]),
@@ -150,9 +424,12 @@ async def process_face(
             new_face_encoding,
             additional_info_dict
         )
+        _add_derived_fields(face_document, new_face_encoding)
         
-        # Store in database
+        # Store in database; past this point the request runs to completion
+        begin_write()
         face_id = await db.insert_face(face_document)
+        await _publish_face(face_document, face_id)
         
         return {
             "id": face_id,
@@ -162,9 +439,47 @@ async def process_face(
             "is_duplicate": False
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing face: {str(e)}")
 
+def _detect_and_encode(contents: bytes, max_faces: int) -> List[tuple]:
+    """
+    Decode an uploaded image, detect faces and encode up to max_faces of them
+
+    Returns:
+        List of (box, encoding, face image as base64) tuples
+    """
+    nparr = np.frombuffer(contents, np.uint8)
+    import cv2
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    
+    if img is None:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    
+    # Detect faces
+    faces = detect_faces(img)
+    
+    if len(faces) == 0:
+        raise HTTPException(status_code=400, detail="No face detected in the image")
+    
+    detected = []
+    # Limit the number of faces to process
+    for (x, y, w, h) in faces[:max_faces]:
+        face_img = img[y:y+h, x:x+w]
+        
+        # Extract face encoding
+        face_encoding = extract_face_encoding(face_img)
+        
+        # Encode the face image for response
+        _, buffer = cv2.imencode('.jpg', face_img)
+        face_base64 = base64.b64encode(buffer).decode('utf-8')
+        
+        detected.append(((x, y, w, h), face_encoding, face_base64))
+    
+    return detected
+
 @app.post("/recognize-face")
 async def recognize_face(
     image: UploadFile = File(...),
@@ -178,6 +493,7 @@ async def recognize_face(
     - **image**: Image file containing faces to recognize
     - **similarity_threshold**: Threshold for face similarity (0.0 to 1.0)
     - **max_results**: Maximum number of matching results to return per face
+      (distinct identities when identity matching is enabled)
     - **max_faces**: Maximum number of faces to detect and process
     
     Returns:
@@ -187,57 +503,136 @@ async def recognize_face(
     try:
         # Read the image
         contents = await image.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        import cv2
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            raise HTTPException(status_code=400, detail="Could not decode image")
-        
-        # Detect faces
-        faces = detect_faces(img)
+        digest = content_digest(contents)
+
+        snapshot = snapshot_reader.get() if snapshot_reader is not None else None
+        gallery_version = ("snapshot", snapshot.version, pending_faces.latest) if snapshot is not None \
+            else await db.current_gallery_version()
+        if snapshot is None:
+            # Pick up registrations made by other processes in the background
+            if sharded_gallery is not None:
+                _run_in_background(sharded_gallery.maybe_reload(gallery_version[0]))
+            if quantized_index is not None:
+                _run_in_background(quantized_index.maybe_reload(gallery_version[0]))
+
+        # Identical uploads against an unchanged gallery reuse the full response
+        match_key = (digest, similarity_threshold, max_results, max_faces)
+        cached_response = match_cache.get(match_key, version=gallery_version)
+        if cached_response is not None:
+            return cached_response
+
+        # Reuse detection and encoding results for identical uploads
+        feature_key = (digest, max_faces)
+        detected = feature_cache.get(feature_key)
+        if detected is None:
+            detected = _detect_and_encode(contents, max_faces)
+            feature_cache.put(feature_key, detected)
+        check_deadline()
+
+        # The snapshot, shards, quantized index or identity gallery replace the
+        # per-request gallery fetch
+        identity_gallery = await _get_identity_gallery(gallery_version) if USE_IDENTITY_MATCHING else None
+        if identity_gallery is not None:
+            all_faces = identity_gallery.faces
+        elif snapshot is not None:
+            all_faces = pending_faces.since(snapshot)
+        elif sharded_gallery is not None or quantized_index is not None:
+            all_faces = []
+        else:
+            all_faces = await _gallery_faces()
         
-        if len(faces) == 0:
-            raise HTTPException(status_code=400, detail="No face detected in the image")
+        query_encodings = [face_encoding for _, face_encoding, _ in detected]
+        gallery_encodings = [db_face["face_encoding"] for db_face in all_faces]
         
-        # Limit the number of faces to process
-        faces = faces[:max_faces]
+        # Top-k (gallery indices, scores) per detected face, best first
+        indexed_matches = None
+        identity_matches = None
+        if snapshot is not None:
+            # All query faces against the shared memory-mapped matrix at once
+            top_matches = top_k_matches(query_encodings, snapshot.encodings, max_results, similarity_threshold)
+            if all_faces:
+                # Merge in the faces registered here since the snapshot was built,
+                # indexed past its end
+                pending_matches = top_k_matches(
+                    query_encodings, normalized_matrix(gallery_encodings, snapshot.dim, np.float32),
+                    max_results, similarity_threshold
+                )
+                top_matches = [
+                    select_top_k(np.concatenate([scores, pending_scores]), max_results, similarity_threshold,
+                                 np.concatenate([indices, pending_indices + len(snapshot)]))
+                    for (indices, scores), (pending_indices, pending_scores) in zip(top_matches, pending_matches)
+                ]
+        elif sharded_gallery is not None:
+            # Parallel top-k over every shard for all query faces at once
+            indexed_matches = await sharded_gallery.asearch(query_encodings, max_results, similarity_threshold)
+        elif projection_model is not None:
+            # Compact-space search, exact re-scoring of the top candidates
+            gallery_compact = projection.compact_gallery(projection_model, all_faces)
+            top_matches = [
+                select_top_k_pairs(projection.search(
+                    projection_model, face_encoding, gallery_encodings, gallery_compact,
+                    rerank=max(projection.PROJECTION_RERANK, max_results)
+                ), max_results, similarity_threshold)
+                for face_encoding in query_encodings
+            ]
+        elif quantized_index is not None:
+            # Integer similarity over uint8 codes; float encodings are fetched
+            # by _id only to re-score the top candidates
+            indexed_matches = await quantized_index.asearch(query_encodings, max_results, similarity_threshold)
+        elif USE_CASCADE:
+            # Coarse pass prunes the gallery before exact scoring
+            gallery_coarse = cascade_matcher.gallery_features(all_faces)
+            top_matches = [
+                select_top_k_pairs(cascade_matcher.match(
+                    face_encoding, all_faces, gallery_coarse, similarity_threshold
+                ), max_results, similarity_threshold)
+                for face_encoding in query_encodings
+            ]
+        elif identity_gallery is not None:
+            # Identity centroids first, templates only for the shortlisted identities
+            identity_matches = identity_gallery.search(
+                query_encodings, max_results, similarity_threshold
+            )
+        else:
+            # Compare all query faces with all faces in the database at once
+            top_matches = top_k_matches(
+                query_encodings, normalized_matrix(gallery_encodings), max_results, similarity_threshold
+            )
         
-        # Get all faces from database for comparison
-        all_faces = await db.find_all_faces_for_comparison()
+        check_deadline()
         
         # Process each detected face
         face_results = []
-        for i, (x, y, w, h) in enumerate(faces):
-            face_img = img[y:y+h, x:x+w]
-            
-            # Extract face encoding
-            face_encoding = extract_face_encoding(face_img)
-            
-            # Compare with all faces in the database
-            matches = []
-            for db_face in all_faces:
-                known_face_encoding = db_face["face_encoding"]
-                similarity = compare_face_encodings(known_face_encoding, face_encoding)
-                
-                if similarity >= similarity_threshold:
+        for i, ((x, y, w, h), face_encoding, face_base64) in enumerate(detected):
+            if indexed_matches is not None:
+                # The shards or quantized index already filtered and ranked these matches
+                matches = indexed_matches[i]
+            elif identity_matches is not None:
+                # One entry per identity, reported through its best template
+                matches = [
+                    {
+                        "id": str(all_faces[index]["_id"]),
+                        "identity_id": identity_of(all_faces[index]),
+                        "name": all_faces[index]["name"],
+                        "similarity": similarity,
+                        "template_count": template_count,
+                        "registration_timestamp": all_faces[index]["registration_timestamp"]
+                    }
+                    for index, similarity, template_count in identity_matches[i]
+                ]
+            else:
+                # Response entries are only built for the final top-k
+                matches = []
+                for index, similarity in zip(*top_matches[i]):
+                    db_face = _snapshot_record(snapshot, all_faces, int(index)) if snapshot is not None \
+                        else all_faces[index]
                     matches.append({
                         "id": str(db_face["_id"]),
                         "name": db_face["name"],
-                        "similarity": similarity,
+                        "similarity": float(similarity),
                         "registration_timestamp": db_face["registration_timestamp"]
                     })
             
-            # Sort matches by similarity (highest first)
-            matches.sort(key=lambda x: x["similarity"], reverse=True)
-            
-            # Limit results
-            matches = matches[:max_results]
-            
-            # Encode the face image for response
-            _, buffer = cv2.imencode('.jpg', face_img)
-            face_base64 = base64.b64encode(buffer).decode('utf-8')
-            
             # Add this face to results
             face_results.append({
                 "face_id": i,
@@ -247,14 +642,43 @@ async def recognize_face(
                 "total_matches": len(matches)
             })
         
-        return {
-            "total_faces_detected": len(faces),
+        response = {
+            "total_faces_detected": len(detected),
             "faces": face_results
         }
+        match_cache.put(match_key, response, version=gallery_version)
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error recognizing faces: {str(e)}")
 
+@app.get("/cache-stats")
+async def cache_stats():
+    """Hit rates and memory use of the recognition result caches"""
+    return {
+        "gallery_version": list(await db.current_gallery_version()),
+        "caches": [feature_cache.stats(), match_cache.stats()]
+    }
+
+@app.get("/matching-stats")
+async def matching_stats():
+    """How much of the gallery the cascade matcher pruned, and the quantized index size"""
+    return {
+        "cascade_enabled": USE_CASCADE,
+        "cascade": cascade_matcher.stats(),
+        "quantized": quantized_index.memory_report() if quantized_index is not None else None
+    }
+
+@app.get("/admission-stats")
+async def admission_stats():
+    """In-flight work, queue depth and rejections per priority lane"""
+    return {
+        "admission_enabled": USE_ADMISSION_CONTROL,
+        "admission": admission_controller.stats()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
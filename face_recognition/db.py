@@ -1,5 +1,6 @@
 import motor.motor_asyncio
 from bson import ObjectId
+from pymongo import ReturnDocument
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 import asyncio
@@ -10,15 +11,156 @@ dotenv.load_dotenv()
 # MongoDB Atlas connection
 MONGO_CONNECTION_STRING = os.getenv("MONGO_URL")
 
+# Connection pool and timeout tuning
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000"))
+
 # Initialize MongoDB client
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_CONNECTION_STRING)
+client = motor.motor_asyncio.AsyncIOMotorClient(
+    MONGO_CONNECTION_STRING,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS
+)
 db = client.face_recognition  # Database name
 face_collection = db.faces  # Single collection for all face data
+tombstone_collection = db.face_tombstones  # Deleted face IDs for incremental sync
+meta_collection = db.gallery_meta  # Shared gallery version counter
+
+# Document in meta_collection whose value every gallery write increments
+GALLERY_VERSION_ID = "gallery_version"
+
+# Bumped whenever this process changes or reloads its view of the gallery
+# (its own writes, local cache syncs), so cached match results computed
+# against an older view can be detected
+gallery_version = 0
+
+def bump_gallery_version() -> int:
+    """Mark this process's view of the gallery as changed and return the new version"""
+    global gallery_version
+    gallery_version += 1
+    return gallery_version
+
+# Shared counter values of writes this process published to its own gallery
+# copies (shards, quantized index), which need no reload to see them
+_published_changes: set = set()
+PUBLISHED_CHANGES_KEPT = 1024
+
+async def _record_gallery_change(published: bool = False) -> None:
+    """
+    Bump the local version and the shared counter read by every worker
+    
+    Args:
+        published: The caller applies the write to this process's gallery
+            copies itself, so they need not reload for it
+    """
+    bump_gallery_version()
+    counter = await meta_collection.find_one_and_update(
+        {"_id": GALLERY_VERSION_ID}, {"$inc": {"value": 1}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+    if published:
+        _published_changes.add(counter["value"])
+        if len(_published_changes) > PUBLISHED_CHANGES_KEPT:
+            _published_changes.discard(min(_published_changes))
+
+def changed_elsewhere(since: Optional[int], until: int) -> bool:
+    """Whether any shared gallery change after `since` up to `until` was not published by this process"""
+    if since is None or until - since > PUBLISHED_CHANGES_KEPT:
+        return True
+    return any(version not in _published_changes for version in range(since + 1, until + 1))
+
+async def _stamp_synced(collection, ids: List[Any]) -> None:
+    """
+    Set synced_at from the server clock on freshly written documents
+    
+    Local gallery caches sync on synced_at, so the order of changes comes
+    from one clock instead of each writer's registration_timestamp.
+    """
+    if ids:
+        await collection.update_many({"_id": {"$in": list(ids)}}, {"$currentDate": {"synced_at": True}})
+
+async def current_gallery_version() -> tuple:
+    """
+    Version of the gallery for tagging cached match results
+    
+    Combines the shared counter, which changes on writes made through this
+    module by any worker or process, with the local version.
+    """
+    counter = await meta_collection.find_one({"_id": GALLERY_VERSION_ID})
+    return (counter["value"] if counter else 0, gallery_version)
+
+# Case-insensitive comparison for name lookups; must match the name_ci index
+NAME_COLLATION = {"locale": "en", "strength": 2}
+
+# Fields returned by listing and search endpoints (no encodings or images)
+SUMMARY_PROJECTION = {"name": 1, "additional_info": 1, "registration_timestamp": 1}
+
+# Fields needed to match faces; leaves out the stored image and metadata
+MATCHING_PROJECTION = {"face_image_base64": 0, "additional_info": 0}
 
 async def create_indices():
     """Create database indices for better performance"""
     await face_collection.create_index("name")
     await face_collection.create_index("registration_timestamp")
+    await face_collection.create_index("name", name="name_ci", collation=NAME_COLLATION)
+    await face_collection.create_index([("name", "text")], name="name_text")
+    await face_collection.create_index([("registration_timestamp", -1), ("_id", -1)])
+    await face_collection.create_index("identity_id", sparse=True)
+    await face_collection.create_index("synced_at")
+    await tombstone_collection.create_index("deleted_at")
+    await tombstone_collection.create_index("synced_at")
+
+async def stamp_unsynced() -> int:
+    """
+    Give synced_at to faces and tombstones written before it existed
+    
+    Returns:
+        Number of stamped documents; 0 once every document has it
+    """
+    stamped = 0
+    for collection in (face_collection, tombstone_collection):
+        result = await collection.update_many(
+            {"synced_at": {"$exists": False}}, {"$currentDate": {"synced_at": True}}
+        )
+        stamped += result.modified_count
+    return stamped
+
+async def _record_tombstones(face_ids: List[ObjectId]) -> None:
+    """Remember deletions so local gallery caches can drop them"""
+    deleted_at = datetime.now()
+    result = await tombstone_collection.insert_many(
+        [{"face_id": str(face_id), "deleted_at": deleted_at} for face_id in face_ids]
+    )
+    await _stamp_synced(tombstone_collection, result.inserted_ids)
+
+def _to_object_ids(face_ids: List[str]) -> List[ObjectId]:
+    return [ObjectId(face_id) for face_id in face_ids if ObjectId.is_valid(face_id)]
+
+def _stringify_ids(faces: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    for face in faces:
+        face["_id"] = str(face["_id"])
+    return faces
+
+def encode_page_cursor(face: Dict[str, Any]) -> str:
+    """Opaque keyset cursor pointing just after the given face"""
+    return f"{face['registration_timestamp'].isoformat()}_{face['_id']}"
+
+def decode_page_cursor(cursor: str) -> Dict[str, Any]:
+    """Query selecting faces that sort after the cursor (newest first)"""
+    timestamp, face_id = cursor.rsplit("_", 1)
+    timestamp = datetime.fromisoformat(timestamp)
+    return {"$or": [
+        {"registration_timestamp": {"$lt": timestamp}},
+        {"registration_timestamp": timestamp, "_id": {"$lt": ObjectId(face_id)}}
+    ]}
 
 async def insert_face(face_document: Dict[str, Any]) -> str:
     """
@@ -30,83 +172,288 @@ async def insert_face(face_document: Dict[str, Any]) -> str:
     Returns:
         ID of the inserted document
     """
-    result = await face_collection.insert_one(face_document)
-    return str(result.inserted_id)
+    # Inserted and stamped in one write, so no stored face can miss synced_at
+    face_id = face_document.setdefault("_id", ObjectId())
+    fields = {key: value for key, value in face_document.items() if key != "_id"}
+    await face_collection.update_one(
+        {"_id": face_id}, {"$setOnInsert": fields, "$currentDate": {"synced_at": True}}, upsert=True
+    )
+    # The face service publishes its registrations to its gallery copies
+    await _record_gallery_change(published=True)
+    return str(face_id)
 
-async def find_all_faces(skip: int = 0, limit: int = 10) -> Dict[str, Any]:
+async def insert_faces(face_documents: List[Dict[str, Any]]) -> List[str]:
     """
-    Retrieve all faces with pagination
+    Insert many face documents in one round trip
     
     Args:
-        skip: Number of documents to skip
-        limit: Maximum number of documents to return
+        face_documents: Dictionaries with face data
         
     Returns:
-        Dictionary with total count and face documents
+        IDs of the inserted documents
     """
-    # Get total count
-    total = await face_collection.count_documents({})
+    if not face_documents:
+        return []
+    try:
+        result = await face_collection.insert_many(face_documents, ordered=False)
+    finally:
+        # An unordered insert can write part of the batch before failing;
+        # the driver has set _id on every document either way
+        await _stamp_synced(face_collection, [face["_id"] for face in face_documents if "_id" in face])
+        await _record_gallery_change()
+    return [str(inserted_id) for inserted_id in result.inserted_ids]
+
+async def stream_faces(
+    projection: Optional[Dict[str, Any]] = None,
+    batch_size: int = 1000
+):
+    """
+    Yield lists of face documents in _id order without loading the gallery
     
-    # Retrieve faces with pagination
-    cursor = face_collection.find().sort("registration_timestamp", -1).skip(skip).limit(limit)
+    Args:
+        projection: Fields to return
+        batch_size: Documents per yielded list and per server round trip
+        
+    Yields:
+        Lists of up to batch_size face documents
+    """
+    cursor = face_collection.find({}, projection).sort("_id", 1).batch_size(batch_size)
+    batch = []
+    async for face in cursor:
+        batch.append(face)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def find_all_faces(
+    limit: int = 10,
+    after: Optional[str] = None,
+    projection: Optional[Dict[str, Any]] = SUMMARY_PROJECTION,
+    include_total: bool = False
+) -> Dict[str, Any]:
+    """
+    Retrieve faces newest first with keyset pagination
+    
+    Args:
+        limit: Maximum number of documents to return
+        after: next_cursor from the previous page, None for the first page
+        projection: Fields to return (must keep registration_timestamp),
+            None for full documents
+        include_total: Also return the (estimated) collection size
+        
+    Returns:
+        Dictionary with face documents and the cursor for the next page
+    """
+    query = decode_page_cursor(after) if after else {}
+    cursor = face_collection.find(query, projection) \
+        .sort([("registration_timestamp", -1), ("_id", -1)]) \
+        .limit(limit)
     faces = await cursor.to_list(length=limit)
     
-    # Convert ObjectId to string for JSON response
-    for face in faces:
-        face["_id"] = str(face["_id"])
+    next_cursor = encode_page_cursor(faces[-1]) if len(faces) == limit else None
     
     return {
-        "total": total,
-        "faces": faces,
-        "skip": skip,
-        "limit": limit
+        "total": await face_collection.estimated_document_count() if include_total else None,
+        "faces": _stringify_ids(faces),
+        "limit": limit,
+        "next_cursor": next_cursor
     }
 
-async def find_face_by_id(face_id: str) -> Optional[Dict[str, Any]]:
+async def find_faces_by_ids(face_ids: List[str],
+                            projection: Optional[Dict[str, Any]] = SUMMARY_PROJECTION) -> List[Dict[str, Any]]:
+    """Fetch several faces by ID in one query"""
+    object_ids = _to_object_ids(face_ids)
+    if not object_ids:
+        return []
+    cursor = face_collection.find({"_id": {"$in": object_ids}}, projection)
+    return _stringify_ids(await cursor.to_list(length=len(object_ids)))
+
+async def find_face_by_id(face_id: str, projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
    
     if not ObjectId.is_valid(face_id):
         return None
     
-    face = await face_collection.find_one({"_id": ObjectId(face_id)})
+    face = await face_collection.find_one({"_id": ObjectId(face_id)}, projection)
     
     if face:
         face["_id"] = str(face["_id"])
     
     return face
 
+async def find_identity_templates(identity_id: str,
+                                  projection: Optional[Dict[str, Any]] = MATCHING_PROJECTION) -> List[Dict[str, Any]]:
+    """
+    Fetch every template enrolled for an identity
+    
+    Args:
+        identity_id: ID of any face document of the identity; templates
+            are resolved to the identity's first (root) face document
+        projection: Fields to return
+        
+    Returns:
+        Template documents, the root document included
+    """
+    if not ObjectId.is_valid(identity_id):
+        return []
+    face = await face_collection.find_one({"_id": ObjectId(identity_id)}, {"identity_id": 1})
+    if face is None:
+        return []
+    root_id = face.get("identity_id") or identity_id
+    cursor = face_collection.find(
+        {"$or": [{"_id": ObjectId(root_id)}, {"identity_id": root_id}]}, projection
+    )
+    return await cursor.to_list(length=None)
+
+async def set_identity_centroid(identity_id: str, fields: Dict[str, Any]) -> bool:
+    """
+    Store the identity centroid on its root face document
+    
+    Args:
+        identity_id: ID of the identity's root face document
+        fields: identity_centroid and identity_template_count
+        
+    Returns:
+        True if the root document was updated
+    """
+    result = await face_collection.update_one(
+        {"_id": ObjectId(identity_id)},
+        {"$set": {"identity_id": identity_id, **fields}, "$currentDate": {"synced_at": True}}
+    )
+    # Centroids are not part of the shard or quantized gallery copies
+    await _record_gallery_change(published=True)
+    return result.modified_count > 0
+
 async def delete_face_by_id(face_id: str) -> bool:
     
     if not ObjectId.is_valid(face_id):
         return False
     
     result = await face_collection.delete_one({"_id": ObjectId(face_id)})
+    if result.deleted_count > 0:
+        await _record_tombstones([ObjectId(face_id)])
+        await _record_gallery_change()
     return result.deleted_count > 0
 
-async def search_faces_by_name(name: str, limit: int = 10) -> Dict[str, Any]:
-   
-    # Create a case-insensitive regex search
-    query = {"name": {"$regex": name, "$options": "i"}}
+async def delete_faces_by_ids(face_ids: List[str]) -> int:
+    """
+    Delete many faces in one round trip
+    
+    Returns:
+        Number of deleted documents
+    """
+    object_ids = _to_object_ids(face_ids)
+    if not object_ids:
+        return 0
     
-    # Count matching documents
-    total = await face_collection.count_documents(query)
+    # Only faces that exist get a tombstone
+    existing = await face_collection.distinct("_id", {"_id": {"$in": object_ids}})
+    if not existing:
+        return 0
+    result = await face_collection.delete_many({"_id": {"$in": existing}})
+    if result.deleted_count > 0:
+        await _record_tombstones(existing)
+        await _record_gallery_change()
+    return result.deleted_count
+
+async def search_faces_by_name(
+    name: str,
+    limit: int = 10,
+    mode: str = "prefix",
+    projection: Optional[Dict[str, Any]] = SUMMARY_PROJECTION,
+    include_total: bool = False
+) -> Dict[str, Any]:
+    """
+    Search faces by name using an index
     
-    # Get matching faces
-    cursor = face_collection.find(query).limit(limit)
+    Args:
+        name: Name or name prefix to look for
+        limit: Maximum number of documents to return
+        mode: "prefix" or "exact" (case-insensitive, served by the name_ci
+            collation index) or "text" (word match on the name_text index)
+        projection: Fields to return, None for full documents
+        include_total: Also count all matching documents
+        
+    Returns:
+        Dictionary with matching face documents
+    """
+    collation = NAME_COLLATION
+    if mode == "exact":
+        query = {"name": name}
+    elif mode == "prefix":
+        # Range over the collation index instead of an unanchored regex
+        query = {"name": {"$gte": name, "$lt": name + "\uffff"}}
+    elif mode == "text":
+        query = {"$text": {"$search": name}}
+        collation = None
+    else:
+        raise ValueError(f"Unknown name search mode: {mode}")
+    
+    options = {"collation": collation} if collation else {}
+    cursor = face_collection.find(query, projection, **options).limit(limit)
     faces = await cursor.to_list(length=limit)
     
-    # Convert ObjectId to string
-    for face in faces:
-        face["_id"] = str(face["_id"])
+    total = await face_collection.count_documents(query, **options) if include_total else None
     
     return {
         "total": total,
-        "faces": faces,
+        "faces": _stringify_ids(faces),
         "query": name
     }
 
+async def set_compact_encodings(compact_encodings: List[tuple], projection_version: int) -> int:
+    """
+    Store projected encodings produced by a fitted projection
+
+    Args:
+        compact_encodings: List of (face ID, compact encoding) pairs
+        projection_version: Version of the projection that produced them
+
+    Returns:
+        Number of modified documents
+    """
+    from pymongo import UpdateOne
+
+    if not compact_encodings:
+        return 0
+
+    operations = [
+        UpdateOne(
+            {"_id": ObjectId(face_id) if isinstance(face_id, str) else face_id},
+            {"$set": {"compact_encoding": compact, "projection_version": projection_version}}
+        )
+        for face_id, compact in compact_encodings
+    ]
+    result = await face_collection.bulk_write(operations, ordered=False)
+    await _record_gallery_change()
+    return result.modified_count
+
+async def set_quantized_encodings(quantized: List[tuple]) -> int:
+    """
+    Store quantized fields computed for faces registered without them
+
+    Args:
+        quantized: List of (face ID, quantized_fields dict) pairs
+
+    Returns:
+        Number of modified documents
+    """
+    from pymongo import UpdateOne
+
+    if not quantized:
+        return 0
+
+    operations = [
+        UpdateOne({"_id": ObjectId(face_id) if isinstance(face_id, str) else face_id}, {"$set": fields})
+        for face_id, fields in quantized
+    ]
+    result = await face_collection.bulk_write(operations, ordered=False)
+    return result.modified_count
+
 async def find_all_faces_for_comparison() -> List[Dict[str, Any]]:
    
-    cursor = face_collection.find()
+    cursor = face_collection.find({}, MATCHING_PROJECTION)
     faces = await cursor.to_list(length=1000)  # Limit to 1000 faces for performance
     
     return faces 
\ No newline at end of file
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from bson import ObjectId
+
+# Gallery cache configuration
+USE_GALLERY_CACHE = os.getenv("USE_GALLERY_CACHE", "false").lower() == "true"
+GALLERY_CACHE_PATH = os.getenv("GALLERY_CACHE_PATH", "gallery_cache.sqlite3")
+GALLERY_CACHE_SYNC_INTERVAL = float(os.getenv("GALLERY_CACHE_SYNC_INTERVAL", "5"))
+# Each sync re-reads this many seconds before the watermark, covering writes
+# stamped before a sync but committed after it
+GALLERY_CACHE_SYNC_OVERLAP = float(os.getenv("GALLERY_CACHE_SYNC_OVERLAP", "60"))
+
+# Fields copied from face documents into the cache
+CACHE_PROJECTION = {"name": 1, "face_encoding": 1, "registration_timestamp": 1, "additional_info": 1,
+                    "identity_id": 1, "synced_at": 1}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS faces (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    encoding BLOB NOT NULL,
+    registration_timestamp TEXT,
+    additional_info TEXT,
+    identity_id TEXT,
+    synced_at TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _encode_timestamp(timestamp: Optional[datetime]) -> Optional[str]:
+    return timestamp.isoformat() if timestamp is not None else None
+
+
+def _decode_timestamp(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+class GalleryCache:
+    """
+    Local SQLite copy of the gallery, kept current with incremental pulls
+
+    Face documents and tombstones carry synced_at, set from the MongoDB
+    server clock on every write (see db._stamp_synced). Two watermarks are
+    persisted: the newest face synced_at and the newest tombstone synced_at
+    seen by a sync. A sync fetches documents stamped since the watermark
+    minus sync_overlap, so a restart loads the gallery from disk and pays
+    for the delta only. Only syncs move the watermarks; faces written
+    through upsert() are pulled again once stamped, which is idempotent.
+    """
+
+    def __init__(self, path: str = GALLERY_CACHE_PATH,
+                 sync_interval: float = GALLERY_CACHE_SYNC_INTERVAL,
+                 sync_overlap: float = GALLERY_CACHE_SYNC_OVERLAP):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_overlap = timedelta(seconds=sync_overlap)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._sync_lock = asyncio.Lock()
+        self._last_sync = 0.0
+        self._faces: Dict[str, Dict[str, Any]] = {}
+        self._synced_at: Dict[str, Optional[str]] = {}
+        self._load()
+
+    def _load(self) -> None:
+        rows = self._conn.execute(
+            "SELECT id, name, encoding, registration_timestamp, additional_info, identity_id, synced_at FROM faces"
+        )
+        for face_id, name, encoding, timestamp, additional_info, identity_id, synced_at in rows:
+            self._synced_at[face_id] = synced_at
+            self._faces[face_id] = {
+                "_id": ObjectId(face_id),
+                "name": name,
+                "face_encoding": np.frombuffer(encoding, dtype="<f8").tolist(),
+                "registration_timestamp": _decode_timestamp(timestamp),
+                "additional_info": json.loads(additional_info) if additional_info else {},
+                "identity_id": identity_id,
+            }
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: Optional[str]) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def watermark(self) -> Optional[datetime]:
+        return _decode_timestamp(self._get_meta("synced_at_watermark"))
+
+    @property
+    def tombstone_watermark(self) -> Optional[datetime]:
+        return _decode_timestamp(self._get_meta("tombstone_synced_at_watermark"))
+
+    def _advance(self, key: str, synced_at: Optional[datetime]) -> None:
+        current = _decode_timestamp(self._get_meta(key))
+        if synced_at is not None and (current is None or synced_at > current):
+            self._set_meta(key, _encode_timestamp(synced_at))
+
+    def __len__(self) -> int:
+        return len(self._faces)
+
+    def faces(self) -> List[Dict[str, Any]]:
+        """Cached face documents, shaped like the MongoDB documents"""
+        return list(self._faces.values())
+
+    def upsert(self, faces: List[Dict[str, Any]]) -> int:
+        """
+        Add or replace faces; faces already cached with the same synced_at are skipped
+
+        Returns:
+            Number of faces added or changed
+        """
+        with self._lock:
+            rows = []
+            for face in faces:
+                face_id = str(face["_id"])
+                synced_at = _encode_timestamp(face.get("synced_at"))
+                if face_id in self._synced_at and self._synced_at[face_id] == synced_at:
+                    continue
+                timestamp = face.get("registration_timestamp")
+                cached = {
+                    "_id": ObjectId(face_id),
+                    "name": face.get("name", ""),
+                    "face_encoding": list(face["face_encoding"]),
+                    "registration_timestamp": timestamp,
+                    "additional_info": face.get("additional_info") or {},
+                    "identity_id": face.get("identity_id"),
+                }
+                self._faces[face_id] = cached
+                self._synced_at[face_id] = synced_at
+                rows.append((
+                    face_id,
+                    cached["name"],
+                    np.asarray(cached["face_encoding"], dtype="<f8").tobytes(),
+                    _encode_timestamp(timestamp),
+                    json.dumps(cached["additional_info"], default=str),
+                    cached["identity_id"],
+                    synced_at,
+                ))
+
+            if rows:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO faces "
+                    "(id, name, encoding, registration_timestamp, additional_info, identity_id, synced_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.commit()
+            return len(rows)
+
+    def remove(self, face_ids: List[str]) -> int:
+        """
+        Drop faces
+
+        Returns:
+            Number of faces that were cached
+        """
+        with self._lock:
+            removed = 0
+            for face_id in face_ids:
+                self._synced_at.pop(str(face_id), None)
+                if self._faces.pop(str(face_id), None) is not None:
+                    removed += 1
+            self._conn.executemany("DELETE FROM faces WHERE id = ?", [(str(i),) for i in face_ids])
+            self._conn.commit()
+            return removed
+
+    def _apply_batch(self, faces: List[Dict[str, Any]]) -> int:
+        changed = self.upsert(faces)
+        with self._lock:
+            self._advance("synced_at_watermark", max((face.get("synced_at") for face in faces
+                                                       if face.get("synced_at") is not None), default=None))
+            self._conn.commit()
+        return changed
+
+    def _apply_tombstones(self, tombstones: List[Dict[str, Any]]) -> int:
+        # A face written again after its deletion (an import keeping IDs) stays
+        face_ids = []
+        for tombstone in tombstones:
+            written = _decode_timestamp(self._synced_at.get(str(tombstone["face_id"])))
+            deleted = tombstone.get("synced_at")
+            if written is None or deleted is None or written <= deleted:
+                face_ids.append(tombstone["face_id"])
+        removed = self.remove(face_ids)
+        with self._lock:
+            self._advance("tombstone_synced_at_watermark", max(
+                (tombstone.get("synced_at") for tombstone in tombstones if tombstone.get("synced_at") is not None),
+                default=None
+            ))
+            self._conn.commit()
+        return removed
+
+    def _since(self, watermark: Optional[datetime]) -> Dict[str, Any]:
+        return {"synced_at": {"$gte": watermark - self.sync_overlap}} if watermark else {}
+
+    async def sync(self, face_collection, tombstone_collection, batch_size: int = 1000) -> Dict[str, int]:
+        """
+        Pull faces and tombstones stamped since the watermarks
+
+        Returns:
+            Numbers of faces actually added or changed and removed; re-read
+            documents that were already cached are not counted
+        """
+        async with self._sync_lock:
+            loop = asyncio.get_running_loop()
+            upserted = 0
+            deleted = 0
+
+            batch = []
+            async for face in face_collection.find(self._since(self.watermark), CACHE_PROJECTION):
+                batch.append(face)
+                if len(batch) >= batch_size:
+                    upserted += await loop.run_in_executor(None, self._apply_batch, batch)
+                    batch = []
+            if batch:
+                upserted += await loop.run_in_executor(None, self._apply_batch, batch)
+
+            batch = []
+            async for tombstone in tombstone_collection.find(self._since(self.tombstone_watermark)):
+                batch.append(tombstone)
+                if len(batch) >= batch_size:
+                    deleted += await loop.run_in_executor(None, self._apply_tombstones, batch)
+                    batch = []
+            if batch:
+                deleted += await loop.run_in_executor(None, self._apply_tombstones, batch)
+
+            self._last_sync = time.monotonic()
+            return {"upserted": upserted, "deleted": deleted}
+
+    async def maybe_sync(self, face_collection, tombstone_collection) -> Optional[Dict[str, int]]:
+        """Sync if the last sync is older than sync_interval seconds; returns the sync's counts"""
+        if time.monotonic() - self._last_sync >= self.sync_interval:
+            return await self.sync(face_collection, tombstone_collection)
+        return None
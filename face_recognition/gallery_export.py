@@ -0,0 +1,317 @@
+import argparse
+import asyncio
+import base64
+import glob
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from bson import ObjectId
+
+# Export/import configuration
+EXPORT_PART_ROWS = int(os.getenv("EXPORT_PART_ROWS", "100000"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "4"))
+
+# Directory layout:
+#   manifest.json       format version, count, dim, dtype, part list
+#   encodings-NNNNN.npy encodings for up to EXPORT_PART_ROWS faces each
+#   metadata.jsonl      one row per face, in encoding order
+#   thumbnails.bin      raw JPEG bytes, located by each row's offset/length
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+METADATA_FILE = "metadata.jsonl"
+THUMBNAILS_FILE = "thumbnails.bin"
+PART_PATTERN = "encodings-{:05d}.npy"
+
+# Only source fields are exported; derived encodings are rebuilt on demand.
+# Identity fields are kept so multi-template identities survive a round trip
+EXPORT_PROJECTION = {"name": 1, "face_encoding": 1, "face_image_base64": 1,
+                     "additional_info": 1, "registration_timestamp": 1,
+                     "identity_id": 1, "identity_centroid": 1, "identity_template_count": 1}
+IDENTITY_FIELDS = ("identity_id", "identity_centroid", "identity_template_count")
+
+
+class _ExportWriter:
+    """Appends faces to an export directory, one encodings part at a time"""
+
+    def __init__(self, directory: str, dim: int, dtype: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.parts: List[Dict[str, Any]] = []
+        self._rows: List[np.ndarray] = []
+        self._metadata = open(os.path.join(directory, METADATA_FILE), "w", encoding="utf-8")
+        self._thumbnails = open(os.path.join(directory, THUMBNAILS_FILE), "wb")
+        self._thumbnail_offset = 0
+
+    def add(self, face_id: str, name: str, encoding, thumbnail: bytes,
+            additional_info: Optional[Dict[str, Any]], registration_timestamp: Optional[datetime],
+            identity: Optional[Dict[str, Any]] = None) -> None:
+        row = np.zeros(self.dim, dtype=self.dtype)
+        values = np.asarray(encoding, dtype=self.dtype)[:self.dim]
+        row[:len(values)] = values
+        self._rows.append(row)
+
+        self._thumbnails.write(thumbnail)
+        self._metadata.write(json.dumps({
+            **(identity or {}),
+            "id": face_id,
+            "name": name,
+            "registration_timestamp": registration_timestamp.isoformat() if registration_timestamp else None,
+            "additional_info": additional_info or {},
+            "encoding_length": min(len(encoding), self.dim),
+            "thumbnail_offset": self._thumbnail_offset,
+            "thumbnail_length": len(thumbnail),
+        }, default=str) + "\n")
+        self._thumbnail_offset += len(thumbnail)
+        self.count += 1
+
+        if len(self._rows) >= EXPORT_PART_ROWS:
+            self._flush_part()
+
+    def _flush_part(self) -> None:
+        if not self._rows:
+            return
+        filename = PART_PATTERN.format(len(self.parts))
+        np.save(os.path.join(self.directory, filename), np.stack(self._rows))
+        self.parts.append({"file": filename, "rows": len(self._rows)})
+        self._rows = []
+
+    def close(self) -> Dict[str, Any]:
+        self._flush_part()
+        self._metadata.close()
+        self._thumbnails.close()
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "count": self.count,
+            "dim": self.dim,
+            "dtype": self.dtype.name,
+            "created_at": datetime.now().isoformat(),
+            "parts": self.parts,
+        }
+        # Written last, so a directory without a manifest is an incomplete export
+        with open(os.path.join(self.directory, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+async def export_gallery(directory: str, dim: int = 800, dtype: str = "float32",
+                         batch_size: int = EXPORT_BATCH_SIZE) -> Dict[str, Any]:
+    """
+    Stream the gallery from MongoDB into an export directory
+
+    Returns:
+        The written manifest
+    """
+    import db
+
+    writer = _ExportWriter(directory, dim, dtype)
+    loop = asyncio.get_running_loop()
+
+    def write_batch(faces):
+        for face in faces:
+            image = face.get("face_image_base64")
+            writer.add(
+                str(face["_id"]),
+                face.get("name", ""),
+                face["face_encoding"],
+                base64.b64decode(image) if image else b"",
+                face.get("additional_info"),
+                face.get("registration_timestamp"),
+                {field: face[field] for field in IDENTITY_FIELDS if face.get(field) is not None},
+            )
+
+    async for faces in db.stream_faces(EXPORT_PROJECTION, batch_size):
+        await loop.run_in_executor(None, write_batch, faces)
+    return writer.close()
+
+
+def read_manifest(directory: str) -> Dict[str, Any]:
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported export format version: {manifest.get('format_version')}")
+    return manifest
+
+
+def iter_documents(directory: str, batch_size: int = IMPORT_BATCH_SIZE,
+                   keep_ids: bool = True) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Face documents from an export directory, in batches ready for insert_many
+
+    Encoding parts are memory-mapped, so only one batch is materialized at a time.
+    Without keep_ids, identity roots get new IDs up front so their templates'
+    identity_id can be rewritten wherever they appear in the export.
+    """
+    manifest = read_manifest(directory)
+    new_identity_ids = None if keep_ids else _new_identity_ids(directory)
+    with open(os.path.join(directory, METADATA_FILE), encoding="utf-8") as metadata, \
+            open(os.path.join(directory, THUMBNAILS_FILE), "rb") as thumbnails:
+        for part in manifest["parts"]:
+            encodings = np.load(os.path.join(directory, part["file"]), mmap_mode="r")
+            for start in range(0, part["rows"], batch_size):
+                rows = np.asarray(encodings[start:start + batch_size], dtype=np.float64)
+                batch = []
+                for row in rows:
+                    meta = json.loads(metadata.readline())
+                    thumbnails.seek(meta["thumbnail_offset"])
+                    thumbnail = thumbnails.read(meta["thumbnail_length"])
+                    timestamp = meta["registration_timestamp"]
+                    document = {
+                        "name": meta["name"],
+                        "face_encoding": row[:meta["encoding_length"]].tolist(),
+                        "face_image_base64": base64.b64encode(thumbnail).decode("utf-8"),
+                        "additional_info": meta["additional_info"],
+                        "registration_timestamp": datetime.fromisoformat(timestamp) if timestamp else datetime.now(),
+                    }
+                    for field in IDENTITY_FIELDS:
+                        if field in meta:
+                            document[field] = meta[field]
+                    if keep_ids:
+                        document["_id"] = ObjectId(meta["id"])
+                    elif new_identity_ids:
+                        if meta["id"] in new_identity_ids:
+                            document["_id"] = new_identity_ids[meta["id"]]
+                        if "identity_id" in document:
+                            document["identity_id"] = str(new_identity_ids[document["identity_id"]])
+                    batch.append(document)
+                yield batch
+
+
+def _new_identity_ids(directory: str) -> Dict[str, ObjectId]:
+    """Fresh IDs for every identity root referenced in an export"""
+    new_ids: Dict[str, ObjectId] = {}
+    with open(os.path.join(directory, METADATA_FILE), encoding="utf-8") as metadata:
+        for line in metadata:
+            identity_id = json.loads(line).get("identity_id")
+            if identity_id is not None and identity_id not in new_ids:
+                new_ids[identity_id] = ObjectId()
+    return new_ids
+
+
+async def _insert_batch(batch: List[Dict[str, Any]], skip_existing: bool) -> int:
+    import db
+    from pymongo.errors import BulkWriteError
+
+    try:
+        return len(await db.insert_faces(batch))
+    except BulkWriteError as e:
+        # Unordered insert: everything except the duplicates was written
+        errors = e.details.get("writeErrors", [])
+        if not skip_existing or any(error.get("code") != 11000 for error in errors):
+            raise
+        return e.details.get("nInserted", 0)
+
+
+async def import_gallery(directory: str, batch_size: int = IMPORT_BATCH_SIZE,
+                         concurrency: int = IMPORT_CONCURRENCY, keep_ids: bool = True,
+                         skip_existing: bool = True) -> int:
+    """
+    Load an export directory into MongoDB with chunked insert_many calls
+
+    Up to `concurrency` inserts are in flight while the next batch is read.
+
+    Returns:
+        Number of inserted faces
+    """
+    loop = asyncio.get_running_loop()
+    batches = iter_documents(directory, batch_size, keep_ids)
+    pending = set()
+    inserted = 0
+
+    while True:
+        batch = await loop.run_in_executor(None, next, batches, None)
+        if batch is None:
+            break
+        pending.add(asyncio.create_task(_insert_batch(batch, skip_existing)))
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            inserted += sum(task.result() for task in done)
+
+    if pending:
+        inserted += sum(await asyncio.gather(*pending))
+    return inserted
+
+
+def synthesize(directory: str, count: int, dim: int = 800, seed: int = 0) -> Dict[str, Any]:
+    """
+    Write an export directory of synthetic faces for seeding test environments
+
+    Encodings follow the shape of real ones (block means then block standard
+    deviations); every face shares one small placeholder thumbnail.
+    """
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    _, thumbnail = cv2.imencode(".jpg", np.full((32, 32, 3), 128, dtype=np.uint8))
+    thumbnail = thumbnail.tobytes()
+    start = datetime.now() - timedelta(seconds=count)
+
+    writer = _ExportWriter(directory, dim, "float32")
+    half = dim // 2
+    for first in range(0, count, EXPORT_PART_ROWS):
+        rows = min(EXPORT_PART_ROWS, count - first)
+        encodings = np.empty((rows, dim), dtype=np.float32)
+        encodings[:, :half] = rng.uniform(40, 220, size=(rows, half))
+        encodings[:, half:] = rng.uniform(2, 40, size=(rows, dim - half))
+        for i in range(rows):
+            index = first + i
+            writer.add(str(ObjectId()), f"synthetic_{index}", encodings[i], thumbnail,
+                       {"source": "synthetic"}, start + timedelta(seconds=index))
+    return writer.close()
+
+
+def _directory_bytes(directory: str) -> int:
+    return sum(os.path.getsize(path) for path in glob.glob(os.path.join(directory, "*")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export, import and synthesize face galleries")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Write the gallery to a directory")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--dtype", default="float32", choices=["float32", "float64"],
+                               help="float64 keeps encodings bit-exact")
+
+    import_parser = subparsers.add_parser("import", help="Insert an exported gallery")
+    import_parser.add_argument("directory")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    import_parser.add_argument("--concurrency", type=int, default=IMPORT_CONCURRENCY)
+    import_parser.add_argument("--new-ids", action="store_true",
+                               help="Let MongoDB assign IDs instead of keeping the exported ones")
+
+    synthesize_parser = subparsers.add_parser("synthesize", help="Write N synthetic faces for seeding")
+    synthesize_parser.add_argument("directory")
+    synthesize_parser.add_argument("--count", type=int, required=True)
+    synthesize_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "export":
+        manifest = asyncio.run(export_gallery(args.directory, dtype=args.dtype))
+        print(f"Exported {manifest['count']} faces to {args.directory}")
+    elif args.command == "import":
+        inserted = asyncio.run(import_gallery(
+            args.directory, args.batch_size, args.concurrency, keep_ids=not args.new_ids
+        ))
+        print(f"Imported {inserted} faces from {args.directory}")
+    else:
+        manifest = synthesize(args.directory, args.count, seed=args.seed)
+        print(f"Wrote {manifest['count']} synthetic faces to {args.directory}")
+
+    elapsed = time.perf_counter() - start
+    if args.command != "import":
+        print(f"{_directory_bytes(args.directory) / 1e6:.1f} MB")
+    print(f"{elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+import argparse
+import asyncio
+import glob
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from bson import ObjectId
+
+# Snapshot configuration
+USE_GALLERY_SNAPSHOT = os.getenv("USE_GALLERY_SNAPSHOT", "false").lower() == "true"
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "2"))
+# Registrations are batched into one rebuild at most this often
+SNAPSHOT_REBUILD_SECONDS = float(os.getenv("SNAPSHOT_REBUILD_SECONDS", "30"))
+
+# File layout (all little-endian):
+#   header      magic, version, count, dim, names_size, gallery_counter
+#   encodings   float32[count, dim], rows L2-normalized
+#   ids         12-byte ObjectIds, count entries
+#   timestamps  int64 milliseconds since epoch, count entries
+#   name_ends   int64 end offset of each name in the names blob
+#   names       UTF-8 names, concatenated
+MAGIC = b"FGSNAP01"
+HEADER = struct.Struct("<8sQQQQQ")
+HEADER_SIZE = 64
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = ".lock"
+
+# Fields read from face documents when rebuilding from MongoDB
+SNAPSHOT_PROJECTION = {"name": 1, "face_encoding": 1, "registration_timestamp": 1}
+
+_FILE_PATTERN = re.compile(r"gallery_v(\d+)\.snap$")
+
+
+def _to_millis(timestamp: Optional[datetime]) -> int:
+    if timestamp is None:
+        return 0
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+
+def _from_millis(millis: int) -> datetime:
+    return datetime.fromtimestamp(millis / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+
+class SnapshotWriter:
+    """
+    Streams face documents into a snapshot file batch by batch
+
+    Encodings go straight to the file after a placeholder header; the
+    per-face sections that follow them are spooled to temporary files and
+    appended on close, when the header is patched with the final count.
+    Memory use is bounded by one batch whatever the gallery size.
+    """
+
+    def __init__(self, path: str, version: int, dim: int = 800, gallery_counter: int = 0):
+        self.path = path
+        self.version = version
+        self.dim = dim
+        self.gallery_counter = gallery_counter
+        self.count = 0
+        self._names_size = 0
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, version, 0, dim, 0, gallery_counter).ljust(HEADER_SIZE, b"\0"))
+        directory = os.path.dirname(os.path.abspath(path))
+        # ids, timestamps, name_ends and names, in file order
+        self._sections = [tempfile.TemporaryFile(dir=directory) for _ in range(4)]
+
+    def add(self, faces: Iterable[Dict[str, Any]]) -> int:
+        """Append faces; returns how many were written"""
+        faces = list(faces)
+        if not faces:
+            return 0
+        rows = np.zeros((len(faces), self.dim), dtype=np.float64)
+        names = []
+        for row, face in zip(rows, faces):
+            values = np.asarray(face["face_encoding"], dtype=np.float64)[:self.dim]
+            row[:len(values)] = values
+            names.append(face.get("name", "").encode("utf-8"))
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self._file.write((rows / norms).astype("<f4").tobytes())
+
+        ids, timestamps, name_ends, names_blob = self._sections
+        ids.write(b"".join(
+            (face["_id"] if isinstance(face["_id"], ObjectId) else ObjectId(face["_id"])).binary
+            for face in faces
+        ))
+        timestamps.write(np.asarray(
+            [_to_millis(face.get("registration_timestamp")) for face in faces], dtype="<i8"
+        ).tobytes())
+        ends = self._names_size + np.cumsum([len(name) for name in names], dtype=np.int64)
+        name_ends.write(ends.astype("<i8").tobytes())
+        names_blob.write(b"".join(names))
+        self._names_size = int(ends[-1])
+        self.count += len(faces)
+        return len(faces)
+
+    def close(self) -> int:
+        """Append the spooled sections, patch the header and fsync; returns the face count"""
+        try:
+            for section in self._sections:
+                section.seek(0)
+                shutil.copyfileobj(section, self._file)
+            self._file.seek(0)
+            self._file.write(HEADER.pack(
+                MAGIC, self.version, self.count, self.dim, self._names_size, self.gallery_counter
+            ))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            self.abort()
+        return self.count
+
+    def abort(self) -> None:
+        for section in self._sections:
+            section.close()
+        self._file.close()
+
+
+def write_snapshot(path: str, version: int, faces: Iterable[Dict[str, Any]], dim: int = 800,
+                   batch_size: int = 1000) -> int:
+    """
+    Write face documents to a snapshot file
+
+    Returns:
+        Number of faces written
+    """
+    writer = SnapshotWriter(path, version, dim)
+    batch = []
+    for face in faces:
+        batch.append(face)
+        if len(batch) >= batch_size:
+            writer.add(batch)
+            batch = []
+    writer.add(batch)
+    return writer.close()
+
+
+class GallerySnapshot:
+    """Read-only, memory-mapped view of a snapshot file shared by all workers"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, count, dim, names_size, gallery_counter = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a gallery snapshot")
+
+        self.version = version
+        self.count = count
+        self.dim = dim
+        # Shared gallery counter read before the build; every write that
+        # bumped the counter up to this value is in the snapshot
+        self.gallery_counter = gallery_counter
+
+        offset = HEADER_SIZE
+        self.encodings = np.memmap(path, dtype="<f4", mode="r", offset=offset, shape=(count, dim)) \
+            if count else np.zeros((0, dim), dtype=np.float32)
+        offset += count * dim * 4
+        raw = np.memmap(path, dtype=np.uint8, mode="r")
+        self._ids = raw[offset:offset + count * 12]
+        offset += count * 12
+        self._timestamps = raw[offset:offset + count * 8].view("<i8")
+        offset += count * 8
+        self._name_ends = raw[offset:offset + count * 8].view("<i8")
+        offset += count * 8
+        self._names = raw[offset:offset + names_size]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def face_id(self, index: int) -> str:
+        return str(ObjectId(bytes(self._ids[index * 12:(index + 1) * 12])))
+
+    def name(self, index: int) -> str:
+        start = int(self._name_ends[index - 1]) if index > 0 else 0
+        return bytes(self._names[start:int(self._name_ends[index])]).decode("utf-8")
+
+    def registration_timestamp(self, index: int) -> datetime:
+        return _from_millis(int(self._timestamps[index]))
+
+    def record(self, index: int) -> Dict[str, Any]:
+        """Face document fields needed to report a match"""
+        return {
+            "_id": self.face_id(index),
+            "name": self.name(index),
+            "registration_timestamp": self.registration_timestamp(index),
+        }
+
+    def scores(self, query_encoding) -> np.ndarray:
+        """Cosine similarity of the query against every snapshot face"""
+        query = np.zeros(self.dim, dtype=np.float32)
+        values = np.asarray(query_encoding, dtype=np.float32)[:self.dim]
+        query[:len(values)] = values
+        norm = np.linalg.norm(query)
+        if norm == 0 or self.count == 0:
+            return np.zeros(self.count, dtype=np.float32)
+        return self.encodings @ (query / norm)
+
+
+def list_versions(directory: str = SNAPSHOT_DIR) -> List[int]:
+    versions = []
+    for path in glob.glob(os.path.join(directory, "gallery_v*.snap")):
+        match = _FILE_PATTERN.search(path)
+        if match:
+            versions.append(int(match.group(1)))
+    return sorted(versions)
+
+
+def _publish(directory: str, filename: str) -> None:
+    """Atomically point CURRENT at a snapshot file"""
+    tmp_path = os.path.join(directory, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(filename)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(directory, CURRENT_FILE))
+
+
+def _acquire_build_lock(directory: str):
+    """Exclusive lock serializing snapshot builders across processes; close the file to release"""
+    import fcntl
+
+    os.makedirs(directory, exist_ok=True)
+    lock = open(os.path.join(directory, LOCK_FILE), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def _next_writer(directory: str, dim: int, gallery_counter: int = 0) -> SnapshotWriter:
+    versions = list_versions(directory)
+    version = versions[-1] + 1 if versions else 1
+    return SnapshotWriter(os.path.join(directory, f"gallery_v{version}.snap.tmp"), version, dim, gallery_counter)
+
+
+def _discard(writer: SnapshotWriter) -> None:
+    writer.abort()
+    if os.path.exists(writer.path):
+        os.remove(writer.path)
+
+
+def _finish(directory: str, writer: SnapshotWriter) -> str:
+    """Close a written snapshot, publish it and drop old versions"""
+    writer.close()
+    path = writer.path[:-len(".tmp")]
+    os.replace(writer.path, path)
+    _publish(directory, os.path.basename(path))
+
+    for old_version in list_versions(directory)[:-SNAPSHOT_KEEP]:
+        os.remove(os.path.join(directory, f"gallery_v{old_version}.snap"))
+    return path
+
+
+def current_path(directory: str = SNAPSHOT_DIR) -> Optional[str]:
+    """Path of the published snapshot, or None before the first build"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def build_snapshot(faces: Iterable[Dict[str, Any]], directory: str = SNAPSHOT_DIR,
+                   dim: int = 800, batch_size: int = 1000) -> str:
+    """
+    Write a new snapshot version and publish it
+
+    Builders in different processes are serialized with a lock file, and
+    only the newest SNAPSHOT_KEEP versions are kept on disk. Workers that
+    still map an older file keep a valid view until they reload.
+    """
+    lock = _acquire_build_lock(directory)
+    try:
+        writer = _next_writer(directory, dim)
+        try:
+            batch = []
+            for face in faces:
+                batch.append(face)
+                if len(batch) >= batch_size:
+                    writer.add(batch)
+                    batch = []
+            writer.add(batch)
+        except BaseException:
+            _discard(writer)
+            raise
+        return _finish(directory, writer)
+    finally:
+        lock.close()
+
+
+class SnapshotReader:
+    """
+    Keeps the current snapshot mapped, remapping when CURRENT changes
+
+    Checking for a new version costs one stat() per call.
+    """
+
+    def __init__(self, directory: str = SNAPSHOT_DIR):
+        self.directory = directory
+        self._snapshot: Optional[GallerySnapshot] = None
+        self._current_mtime: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[GallerySnapshot]:
+        current_path = os.path.join(self.directory, CURRENT_FILE)
+        try:
+            mtime = os.stat(current_path).st_mtime_ns
+        except FileNotFoundError:
+            return self._snapshot
+
+        if mtime != self._current_mtime:
+            with self._lock:
+                if mtime != self._current_mtime:
+                    with open(current_path) as f:
+                        filename = f.read().strip()
+                    try:
+                        self._snapshot = GallerySnapshot(os.path.join(self.directory, filename))
+                        self._current_mtime = mtime
+                    except FileNotFoundError:
+                        # Superseded between reading CURRENT and opening; retry next call
+                        pass
+        return self._snapshot
+
+
+def _published_counter(directory: str) -> Optional[int]:
+    path = current_path(directory)
+    if path is None:
+        return None
+    with open(path, "rb") as f:
+        return HEADER.unpack(f.read(HEADER.size))[5]
+
+
+async def rebuild_from_db(directory: str = SNAPSHOT_DIR, if_missing: bool = False,
+                          covering: Optional[int] = None, batch_size: int = 1000) -> Optional[str]:
+    """
+    Stream the gallery from MongoDB into a new snapshot, batch by batch
+
+    With if_missing, nothing is built when a snapshot is already published
+    once the build lock is held, so workers starting together build it once:
+    the first takes the lock and the others wait for it, then find CURRENT.
+    Likewise with covering, nothing is built when the published snapshot
+    already includes the gallery changes up to that shared counter value,
+    so registrations on several workers are picked up by one rebuild.
+    """
+    import db
+
+    loop = asyncio.get_running_loop()
+    lock = await loop.run_in_executor(None, _acquire_build_lock, directory)
+    try:
+        if if_missing and current_path(directory) is not None:
+            return current_path(directory)
+        published = await loop.run_in_executor(None, _published_counter, directory)
+        if covering is not None and published is not None and published >= covering:
+            return current_path(directory)
+
+        # Read first, so writes that land mid-build are rebuilt again
+        gallery_counter, _ = await db.current_gallery_version()
+        writer = await loop.run_in_executor(None, _next_writer, directory, 800, gallery_counter)
+        try:
+            async for faces in db.stream_faces(SNAPSHOT_PROJECTION, batch_size):
+                await loop.run_in_executor(None, writer.add, faces)
+        except BaseException:
+            _discard(writer)
+            raise
+        return await loop.run_in_executor(None, _finish, directory, writer)
+    finally:
+        lock.close()
+
+
+class PendingFaces:
+    """
+    Faces this worker registered that the published snapshot lacks
+
+    Snapshots are rebuilt at most every SNAPSHOT_REBUILD_SECONDS, so new
+    faces are matched from here until a snapshot covering them is mapped.
+    """
+
+    def __init__(self):
+        self._faces: List[Dict[str, Any]] = []
+        self._counters: List[int] = []
+        self._lock = threading.Lock()
+
+    def add(self, face: Dict[str, Any], gallery_counter: int) -> None:
+        """Keep a face until a snapshot built at or after gallery_counter is published"""
+        with self._lock:
+            self._faces.append(face)
+            self._counters.append(gallery_counter)
+
+    @property
+    def latest(self) -> int:
+        """Shared counter value of the newest pending face, 0 if none"""
+        return self._counters[-1] if self._counters else 0
+
+    def since(self, snapshot: Optional[GallerySnapshot]) -> List[Dict[str, Any]]:
+        """Pending faces the snapshot does not cover, dropping those it does"""
+        covered = snapshot.gallery_counter if snapshot is not None else 0
+        with self._lock:
+            keep = [i for i, counter in enumerate(self._counters) if counter > covered]
+            if len(keep) < len(self._counters):
+                self._faces = [self._faces[i] for i in keep]
+                self._counters = [self._counters[i] for i in keep]
+            return list(self._faces)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the shared gallery snapshot")
+    parser.add_argument("--dir", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    path = asyncio.run(rebuild_from_db(args.dir))
+    snapshot = GallerySnapshot(path)
+    print(f"Published snapshot v{snapshot.version} with {len(snapshot)} faces at {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from matching import normalized_matrix, select_top_k
+
+# Identity matching configuration
+USE_IDENTITY_MATCHING = os.getenv("USE_IDENTITY_MATCHING", "false").lower() == "true"
+IDENTITY_SHORTLIST = int(os.getenv("IDENTITY_SHORTLIST", "10"))
+MAX_TEMPLATES_PER_IDENTITY = int(os.getenv("MAX_TEMPLATES_PER_IDENTITY", "10"))
+# A new template this close to an existing one adds nothing to the identity
+TEMPLATE_REDUNDANT_SIMILARITY = float(os.getenv("TEMPLATE_REDUNDANT_SIMILARITY", "0.99"))
+
+
+def identity_of(face: Dict[str, Any]) -> str:
+    """Identity a face document belongs to; faces enrolled alone are their own identity"""
+    return str(face.get("identity_id") or face["_id"])
+
+
+def centroid(encodings: Sequence[Sequence[float]], dim: Optional[int] = None) -> np.ndarray:
+    """L2-normalized mean of the L2-normalized templates"""
+    mean = normalized_matrix(encodings, dim).mean(axis=0)
+    norm = np.linalg.norm(mean)
+    return mean / norm if norm > 0 else mean
+
+
+def centroid_fields(encodings: Sequence[Sequence[float]]) -> Dict[str, Any]:
+    """Centroid fields stored on an identity's root face document"""
+    return {
+        "identity_centroid": centroid(encodings).tolist(),
+        "identity_template_count": len(encodings),
+    }
+
+
+class IdentityGallery:
+    """
+    Gallery grouped by identity, searched centroid first
+
+    Each identity is scored once through its centroid; only the templates
+    of the best-scoring identities are compared individually. The gallery
+    is normalized once at construction, so instances are meant to be
+    reused until the gallery changes. A face enrolled alone is its own
+    centroid; larger identities take the centroid stored on their root
+    document when its template count still matches, and recompute it
+    otherwise.
+    """
+
+    def __init__(self, faces: List[Dict[str, Any]], dim: Optional[int] = None):
+        self.faces = faces
+        self.dim = dim or max((len(face["face_encoding"]) for face in faces), default=0)
+        self.matrix = normalized_matrix([face["face_encoding"] for face in faces], self.dim)
+
+        groups: Dict[str, List[int]] = {}
+        for index, face in enumerate(faces):
+            groups.setdefault(identity_of(face), []).append(index)
+        self.identity_ids = list(groups)
+        self.templates = [np.asarray(indices, dtype=np.int64) for indices in groups.values()]
+
+        counts = np.fromiter((len(indices) for indices in self.templates), dtype=np.int64, count=len(groups))
+        singles = np.flatnonzero(counts == 1)
+        self.centroids = np.zeros((len(groups), self.dim), dtype=np.float64)
+        if len(singles):
+            first_template = np.concatenate(self.templates)[np.cumsum(counts) - counts]
+            self.centroids[singles] = self.matrix[first_template[singles]]
+        for row in np.flatnonzero(counts > 1):
+            identity_id, indices = self.identity_ids[row], self.templates[row]
+            root = next((faces[i] for i in indices if str(faces[i]["_id"]) == identity_id), None)
+            stored = root.get("identity_centroid") if root is not None else None
+            if (stored is not None and len(stored) == self.dim
+                    and root.get("identity_template_count") == len(indices)):
+                self.centroids[row] = stored
+            else:
+                mean = self.matrix[indices].mean(axis=0)
+                norm = np.linalg.norm(mean)
+                self.centroids[row] = mean / norm if norm > 0 else mean
+
+    def __len__(self) -> int:
+        return len(self.identity_ids)
+
+    def search(self, query_encodings: Sequence[Sequence[float]], k: int, threshold: float,
+               shortlist: int = IDENTITY_SHORTLIST) -> List[List[Tuple[int, float, int]]]:
+        """
+        Top-k identities for each query face
+
+        Returns:
+            For each query, up to k (best template index, similarity,
+            template count) tuples, one per identity, best first
+        """
+        if len(query_encodings) == 0:
+            return []
+        if len(self.identity_ids) == 0:
+            return [[] for _ in query_encodings]
+
+        queries = normalized_matrix(query_encodings, self.dim)
+        centroid_scores = queries @ self.centroids.T
+
+        results = []
+        for query, scores in zip(queries, centroid_scores):
+            # Shortlist on centroids without the threshold: a single template
+            # can clear it while the identity's centroid does not
+            candidates, _ = select_top_k(scores, max(shortlist, k), -np.inf)
+            template_indices = np.concatenate([self.templates[i] for i in candidates])
+            template_scores = self.matrix[template_indices] @ query
+
+            best_index = np.empty(len(candidates), dtype=np.int64)
+            best_score = np.empty(len(candidates), dtype=np.float64)
+            start = 0
+            for position, identity in enumerate(candidates):
+                count = len(self.templates[identity])
+                top = start + int(np.argmax(template_scores[start:start + count]))
+                best_index[position] = template_indices[top]
+                best_score[position] = template_scores[top]
+                start += count
+
+            positions, similarities = select_top_k(best_score, k, threshold)
+            results.append([
+                (int(best_index[p]), float(s), len(self.templates[candidates[p]]))
+                for p, s in zip(positions, similarities)
+            ])
+        return results
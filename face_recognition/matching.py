@@ -0,0 +1,217 @@
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from face_utils import compare_face_encodings
+from projection import to_matrix
+
+# Cascade configuration
+USE_CASCADE = os.getenv("USE_CASCADE", "false").lower() == "true"
+CASCADE_POOL = int(os.getenv("CASCADE_POOL", "4"))
+CASCADE_MARGIN = float(os.getenv("CASCADE_MARGIN", "0.05"))
+CASCADE_KEEP_FRACTION = float(os.getenv("CASCADE_KEEP_FRACTION", "0.05"))
+CASCADE_MIN_CANDIDATES = int(os.getenv("CASCADE_MIN_CANDIDATES", "20"))
+
+# extract_face_encoding emits (mean, std) for each 5x5 block of a 100x100 face
+GRID_SIZE = 20
+ENCODING_DIM = GRID_SIZE * GRID_SIZE * 2
+
+
+def coarse_features(encodings: Sequence[Sequence[float]], pool: int = CASCADE_POOL) -> np.ndarray:
+    """
+    Low-resolution, 8-bit quantized block statistics
+
+    Averages the mean/std grid over pool x pool neighbourhoods, so the
+    default pool of 4 turns 800 floats into 50 bytes per face.
+    """
+    n = len(encodings)
+    cells = GRID_SIZE // pool
+    grid = to_matrix(encodings, ENCODING_DIM).reshape(n, GRID_SIZE, GRID_SIZE, 2)
+    grid = grid[:, :cells * pool, :cells * pool]
+    pooled = grid.reshape(n, cells, pool, cells, pool, 2).mean(axis=(2, 4))
+    return np.clip(np.rint(pooled), 0, 255).astype(np.uint8).reshape(n, -1)
+
+
+def _coarse_similarity(query: np.ndarray, gallery: np.ndarray) -> np.ndarray:
+    """Cosine similarity computed with integer dot products"""
+    gallery_int = gallery.astype(np.int32)
+    query_int = query.astype(np.int32)
+    dots = gallery_int @ query_int
+    norms = np.sqrt((gallery_int * gallery_int).sum(axis=1)) * np.sqrt(float(query_int @ query_int))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(norms > 0, dots / norms, 0.0)
+
+
+class CascadeMatcher:
+    """
+    Two-stage matcher: a coarse pass prunes the gallery, survivors get exact scores
+
+    The coarse pass keeps the best `keep_fraction` of the gallery by coarse
+    similarity, dropping any whose coarse similarity is more than `margin`
+    below the threshold. The best `min_candidates` always survive so small
+    galleries and tight thresholds cannot prune everything.
+    """
+
+    def __init__(self, pool: int = CASCADE_POOL, margin: float = CASCADE_MARGIN,
+                 keep_fraction: float = CASCADE_KEEP_FRACTION,
+                 min_candidates: int = CASCADE_MIN_CANDIDATES):
+        self.pool = pool
+        self.margin = margin
+        self.keep_fraction = keep_fraction
+        self.min_candidates = min_candidates
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.gallery_scanned = 0
+        self.candidates_scored = 0
+
+    def gallery_features(self, faces: List[Dict[str, Any]]) -> np.ndarray:
+        """Coarse gallery matrix, reusing coarse_encoding stored at registration"""
+        expected_dim = 2 * (GRID_SIZE // self.pool) ** 2
+        coarse = np.zeros((len(faces), expected_dim), dtype=np.uint8)
+        missing = []
+        for i, face in enumerate(faces):
+            stored = face.get("coarse_encoding")
+            if stored is not None and len(stored) == expected_dim:
+                coarse[i] = stored
+            else:
+                missing.append(i)
+
+        if missing:
+            coarse[missing] = coarse_features([faces[i]["face_encoding"] for i in missing], self.pool)
+        return coarse
+
+    def candidates(self, query_encoding: Sequence[float], gallery_coarse: np.ndarray,
+                   threshold: float) -> np.ndarray:
+        """Indices of gallery faces surviving the coarse pass, best first"""
+        if len(gallery_coarse) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        query_coarse = coarse_features([query_encoding], self.pool)[0]
+        scores = _coarse_similarity(query_coarse, gallery_coarse)
+        order = np.argsort(-scores, kind="stable")
+
+        survivors = int(np.ceil(self.keep_fraction * len(order)))
+        survivors = min(survivors, int(np.count_nonzero(scores >= threshold - self.margin)))
+        survivors = max(survivors, min(self.min_candidates, len(order)))
+        return order[:survivors]
+
+    def match(self, query_encoding: Sequence[float], faces: List[Dict[str, Any]],
+              gallery_coarse: np.ndarray, threshold: float,
+              first_only: bool = False) -> List[Tuple[int, float]]:
+        """
+        Exact similarity for faces surviving the coarse pass
+
+        Args:
+            query_encoding: Encoding of the query face
+            faces: Gallery documents with face_encoding
+            gallery_coarse: Output of gallery_features for the same documents
+            threshold: Similarity threshold used by the caller
+            first_only: Stop at the first survivor reaching the threshold
+
+        Returns:
+            List of (gallery index, similarity) for every scored survivor
+        """
+        survivors = self.candidates(query_encoding, gallery_coarse, threshold)
+
+        scored = []
+        for index in survivors:
+            similarity = compare_face_encodings(faces[index]["face_encoding"], query_encoding)
+            scored.append((int(index), similarity))
+            if first_only and similarity >= threshold:
+                break
+
+        with self._lock:
+            self.queries += 1
+            self.gallery_scanned += len(faces)
+            self.candidates_scored += len(scored)
+        return scored
+
+    def stats(self) -> Dict[str, Any]:
+        scanned = self.gallery_scanned
+        return {
+            "queries": self.queries,
+            "gallery_scanned": scanned,
+            "candidates_scored": self.candidates_scored,
+            "pruned_fraction": 1 - self.candidates_scored / scanned if scanned else 0.0,
+            "pool": self.pool,
+            "margin": self.margin,
+            "keep_fraction": self.keep_fraction,
+            "min_candidates": self.min_candidates,
+        }
+
+
+cascade_matcher = CascadeMatcher()
+
+
+def normalized_matrix(encodings: Sequence[Sequence[float]], dim: Optional[int] = None,
+                      dtype=np.float64) -> np.ndarray:
+    """
+    Zero-padded, L2-normalized encoding matrix
+
+    Dot products between rows equal compare_face_encodings, which pads the
+    shorter vector with zeros and returns 0.0 for zero-norm vectors.
+    """
+    matrix = to_matrix(encodings, dim)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = np.inf
+    return (matrix / norms).astype(dtype, copy=False)
+
+
+def select_top_k(scores: np.ndarray, k: int, threshold: float,
+                 indices: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The k best scores at or above threshold, using partial selection
+
+    Returns:
+        (gallery indices, scores), highest score first
+    """
+    scores = np.asarray(scores)
+    if indices is None:
+        indices = np.arange(len(scores))
+
+    mask = scores >= threshold
+    scores, indices = scores[mask], indices[mask]
+    if k <= 0:
+        return indices[:0], scores[:0]
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        scores, indices = scores[part], indices[part]
+
+    order = np.argsort(-scores, kind="stable")
+    return indices[order], scores[order]
+
+
+def select_top_k_pairs(scored: Iterable[Tuple[int, float]], k: int,
+                       threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """select_top_k for an iterable of (gallery index, score) pairs"""
+    pairs = list(scored)
+    indices = np.fromiter((index for index, _ in pairs), dtype=np.int64, count=len(pairs))
+    scores = np.fromiter((score for _, score in pairs), dtype=np.float64, count=len(pairs))
+    return select_top_k(scores, k, threshold, indices)
+
+
+def top_k_matches(query_encodings: Sequence[Sequence[float]], gallery: np.ndarray, k: int,
+                  threshold: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Top-k matches for every query face from a single matrix product
+
+    Args:
+        query_encodings: Encodings of all faces detected in an image
+        gallery: Row-normalized gallery matrix (see normalized_matrix)
+        k: Maximum number of matches per query face
+        threshold: Minimum cosine similarity
+
+    Returns:
+        One (gallery indices, scores) pair per query face, best first
+    """
+    if len(query_encodings) == 0:
+        return []
+    if len(gallery) == 0:
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        return [empty for _ in query_encodings]
+
+    queries = normalized_matrix(query_encodings, gallery.shape[1], gallery.dtype)
+    scores = queries @ gallery.T
+    return [select_top_k(row, k, threshold) for row in scores]
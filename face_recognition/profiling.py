@@ -0,0 +1,329 @@
+import asyncio
+import glob
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+# Profiling configuration; nothing is installed unless USE_PROFILING is set
+USE_PROFILING = os.getenv("USE_PROFILING", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+PROFILE_TRACE_ALLOCATIONS = os.getenv("PROFILE_TRACE_ALLOCATIONS", "true").lower() == "true"
+# The profile header must carry this value; without a token only sampling applies
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+# Profiles kept in PROFILE_DIR; older ones are deleted as new ones are written
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))
+PROFILE_HEADER = "x-profile"
+TOP_ALLOCATIONS = 20
+
+# Innermost frames of threads that are waiting rather than working
+_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of all threads on a fixed interval
+
+    Stacks are kept in collapsed form ("outer;...;inner" -> count), the
+    input format of flamegraph.pl and speedscope. Threads parked in a wait
+    are skipped, so the profile shows where time is spent working.
+    """
+
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._switch_interval: Optional[float] = None
+
+    def start(self) -> None:
+        # A busy thread only yields the GIL every switch interval (5ms by
+        # default); shorten it so the sampler can actually run at its rate
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch_interval, self.interval / 2))
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._switch_interval is not None:
+            sys.setswitchinterval(self._switch_interval)
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+class _AllocationSummaries:
+    """Per-endpoint allocation totals across profiled requests"""
+
+    def __init__(self):
+        self._endpoints: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint: str, peak_bytes: int, sites: List[tuple]) -> Dict[str, Any]:
+        with self._lock:
+            summary = self._endpoints.setdefault(endpoint, {
+                "endpoint": endpoint, "requests": 0, "total_peak_bytes": 0, "max_peak_bytes": 0, "sites": Counter()
+            })
+            summary["requests"] += 1
+            summary["total_peak_bytes"] += peak_bytes
+            summary["max_peak_bytes"] = max(summary["max_peak_bytes"], peak_bytes)
+            for site, size in sites:
+                summary["sites"][site] += size
+            return {
+                "endpoint": endpoint,
+                "requests": summary["requests"],
+                "mean_peak_bytes": summary["total_peak_bytes"] // summary["requests"],
+                "max_peak_bytes": summary["max_peak_bytes"],
+                "top_sites": [
+                    {"site": site, "bytes": size}
+                    for site, size in summary["sites"].most_common(TOP_ALLOCATIONS)
+                ],
+            }
+
+
+class Profile:
+    """One profiled request: stack samples plus, optionally, traced allocations"""
+
+    def __init__(self, name: str, endpoint: str, trace_allocations: bool = PROFILE_TRACE_ALLOCATIONS):
+        self.name = name
+        self.endpoint = endpoint
+        self.sampler = StackSampler()
+        self.trace_allocations = trace_allocations and not tracemalloc.is_tracing()
+        self.peak_bytes = 0
+        self.allocation_sites: List[tuple] = []
+        self.started = 0.0
+        self.elapsed = 0.0
+        # Other requests running at some point during the profile; their
+        # work is in the samples and allocations too
+        self.concurrent_requests = 0
+
+    def start(self) -> None:
+        if self.trace_allocations:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        self.sampler.start()
+
+    def stop(self) -> None:
+        self.sampler.stop()
+        self.elapsed = time.perf_counter() - self.started
+        if self.trace_allocations:
+            _, self.peak_bytes = tracemalloc.get_traced_memory()
+            # Leave out the sampler's own bookkeeping
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+            tracemalloc.stop()
+            self.allocation_sites = [
+                (str(stat.traceback[0]), stat.size)
+                for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+            ]
+
+
+class Profiler:
+    """
+    Decides which requests to profile and writes the results
+
+    A request is profiled when its profile header matches PROFILE_TOKEN or
+    it falls in the PROFILE_SAMPLE_RATE fraction. The header is ignored
+    when no token is set, so clients cannot slow the service down at will.
+    Only one request is profiled at a time. The stack sampler and
+    tracemalloc are process-wide, so requests running alongside the
+    profiled one show up in its profile and are slowed down by it; their
+    number is recorded as the profile's concurrent_requests.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 token: str = PROFILE_TOKEN, keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.keep = keep
+        self.allocations = _AllocationSummaries()
+        self._busy = threading.Lock()
+        self._sequence = 0
+
+    def wants(self, headers: List[tuple]) -> bool:
+        for key, value in headers:
+            if key == PROFILE_HEADER.encode("latin-1"):
+                return bool(self.token) and value.decode("latin-1") == self.token
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def begin(self, method: str, path: str) -> Optional[Profile]:
+        """Start profiling, or None if another request is already being profiled"""
+        if not self._busy.acquire(blocking=False):
+            return None
+        self._sequence += 1
+        endpoint = f"{method} {path}"
+        name = f"{_slug(endpoint)}-{datetime.now().strftime('%Y%m%dT%H%M%S')}-{self._sequence}"
+        profile = Profile(name, endpoint)
+        profile.start()
+        return profile
+
+    def end(self, profile: Profile) -> None:
+        try:
+            profile.stop()
+        finally:
+            self._busy.release()
+
+    def write(self, profile: Profile, status_code: Optional[int]) -> None:
+        """Write the collapsed stacks and update the endpoint's allocation summary"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, profile.name + ".collapsed"), "w") as f:
+            f.write(profile.sampler.collapsed())
+
+        meta = {
+            "endpoint": profile.endpoint,
+            "status_code": status_code,
+            "elapsed_ms": profile.elapsed * 1000,
+            "samples": profile.sampler.samples,
+            "interval_ms": profile.sampler.interval * 1000,
+            "concurrent_requests": profile.concurrent_requests,
+        }
+        if profile.trace_allocations:
+            meta["peak_bytes"] = profile.peak_bytes
+            meta["top_allocations"] = [{"site": site, "bytes": size} for site, size in profile.allocation_sites]
+            summary = self.allocations.add(profile.endpoint, profile.peak_bytes, profile.allocation_sites)
+            _write_json(os.path.join(self.directory, f"allocations-{_slug(profile.endpoint)}.json"), summary)
+        _write_json(os.path.join(self.directory, profile.name + ".json"), meta)
+        self._prune()
+
+    def _prune(self) -> None:
+        """Delete the oldest profiles beyond the retention limit"""
+        if self.keep <= 0:
+            return
+        profiles = sorted(
+            glob.glob(os.path.join(self.directory, "*.collapsed")), key=os.path.getmtime, reverse=True
+        )
+        for path in profiles[self.keep:]:
+            for stale in (path, path[:-len(".collapsed")] + ".json"):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+
+
+def _slug(endpoint: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", endpoint).strip("_")
+
+
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _with_header(send, name: bytes, value: bytes):
+    """ASGI send callable that adds a header to the response"""
+
+    async def send_with_header(message):
+        if message["type"] == "http.response.start":
+            message = dict(message)
+            message["headers"] = list(message.get("headers", [])) + [(name, value)]
+        await send(message)
+
+    return send_with_header
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles selected HTTP requests
+
+    The profile name is returned in the X-Profile-Id response header; a
+    selected request that finds another one being profiled gets
+    X-Profile-Skipped instead. Unselected requests pay for one header scan
+    and an in-flight count.
+    """
+
+    def __init__(self, app, profiler: Optional[Profiler] = None):
+        self.app = app
+        self.profiler = profiler or Profiler()
+        self.in_flight = 0
+        self.active: Optional[Profile] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        self.in_flight += 1
+        try:
+            if self.active is not None:
+                self.active.concurrent_requests += 1
+            if not self.profiler.wants(scope.get("headers", [])):
+                await self.app(scope, receive, send)
+                return
+
+            profile = self.profiler.begin(scope["method"], scope["path"])
+            if profile is None:
+                await self.app(scope, receive, _with_header(send, b"x-profile-skipped", b"busy"))
+                return
+            # Requests already running are in the profile too
+            profile.concurrent_requests = self.in_flight - 1
+            await self._profile(profile, scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    async def _profile(self, profile: Profile, scope, receive, send) -> None:
+        status_code = None
+        send_with_id = _with_header(send, b"x-profile-id", profile.name.encode("latin-1"))
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send_with_id(message)
+
+        self.active = profile
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.active = None
+            self.profiler.end(profile)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.profiler.write, profile, status_code)
@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import glob
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from face_utils import compare_face_encodings
+
+# Projection configuration
+USE_PROJECTION = os.getenv("USE_PROJECTION", "false").lower() == "true"
+PROJECTION_DIR = os.getenv("PROJECTION_DIR", "projections")
+PROJECTION_DIM = int(os.getenv("PROJECTION_DIM", "96"))
+PROJECTION_RERANK = int(os.getenv("PROJECTION_RERANK", "50"))
+
+_FILE_PATTERN = re.compile(r"projection_v(\d+)\.npz$")
+
+
+def to_matrix(encodings: Sequence[Sequence[float]], dim: Optional[int] = None) -> np.ndarray:
+    """
+    Stack encodings into a float64 matrix, zero-padding (or truncating) to dim
+
+    Padding matches how compare_face_encodings handles vectors of different length.
+    """
+    if dim is None:
+        dim = max((len(e) for e in encodings), default=0)
+    matrix = np.zeros((len(encodings), dim), dtype=np.float64)
+    for i, encoding in enumerate(encodings):
+        values = np.asarray(encoding, dtype=np.float64)[:dim]
+        matrix[i, :len(values)] = values
+    return matrix
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class Projection:
+    """
+    Linear map from full encodings to compact vectors
+
+    Compact vectors are L2-normalized, so their dot product approximates the
+    cosine similarity computed by compare_face_encodings.
+    """
+
+    def __init__(self, matrix: np.ndarray, version: int, method: str):
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        self.version = version
+        self.method = method
+
+    @property
+    def input_dim(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def output_dim(self) -> int:
+        return self.matrix.shape[1]
+
+    def transform(self, encodings: Sequence[Sequence[float]]) -> np.ndarray:
+        full = _normalize_rows(to_matrix(encodings, self.input_dim)).astype(np.float32)
+        return _normalize_rows(full @ self.matrix).astype(np.float32)
+
+    def save(self, directory: str = PROJECTION_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"projection_v{self.version}.npz")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, matrix=self.matrix, version=self.version, method=self.method)
+        # Publish atomically so readers never see a partial file
+        os.replace(tmp_path, path)
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> "Projection":
+        with np.load(path) as data:
+            return cls(data["matrix"], int(data["version"]), str(data["method"]))
+
+
+def fit_pca(encodings: Sequence[Sequence[float]], n_components: int = PROJECTION_DIM,
+            version: int = 1) -> Projection:
+    """
+    Fit a PCA projection on gallery encodings
+
+    The basis is computed on uncentered, normalized vectors so that dot
+    products (and therefore cosine similarity) are preserved as well as possible.
+    """
+    full = _normalize_rows(to_matrix(encodings))
+    n_components = min(n_components, *full.shape)
+    _, _, vt = np.linalg.svd(full, full_matrices=False)
+    return Projection(vt[:n_components].T, version, "pca")
+
+
+def fit_random_projection(input_dim: int, n_components: int = PROJECTION_DIM,
+                          version: int = 1, seed: int = 0) -> Projection:
+    """Gaussian random projection; needs no training data"""
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((input_dim, n_components)) / np.sqrt(n_components)
+    return Projection(matrix, version, "random")
+
+
+def list_versions(directory: str = PROJECTION_DIR) -> List[int]:
+    versions = []
+    for path in glob.glob(os.path.join(directory, "projection_v*.npz")):
+        match = _FILE_PATTERN.search(path)
+        if match:
+            versions.append(int(match.group(1)))
+    return sorted(versions)
+
+
+def load_latest(directory: str = PROJECTION_DIR) -> Optional[Projection]:
+    """Load the newest persisted projection, or None if none has been fitted"""
+    versions = list_versions(directory)
+    if not versions:
+        return None
+    return Projection.load(os.path.join(directory, f"projection_v{versions[-1]}.npz"))
+
+
+def compact_gallery(projection: Projection, faces: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    Compact matrix for gallery documents
+
+    Uses the stored compact_encoding when it was produced by this projection
+    version and projects the full encoding otherwise.
+    """
+    compact = np.zeros((len(faces), projection.output_dim), dtype=np.float32)
+    missing = []
+    for i, face in enumerate(faces):
+        stored = face.get("compact_encoding")
+        if stored is not None and face.get("projection_version") == projection.version:
+            compact[i] = stored
+        else:
+            missing.append(i)
+
+    if missing:
+        compact[missing] = projection.transform([faces[i]["face_encoding"] for i in missing])
+    return compact
+
+
+def search(projection: Projection, query_encoding: Sequence[float],
+           gallery_encodings: Sequence[Sequence[float]], gallery_compact: np.ndarray,
+           rerank: int = PROJECTION_RERANK) -> List[Tuple[int, float]]:
+    """
+    Approximate search in compact space, re-ranked with exact similarity
+
+    Returns:
+        List of (gallery index, exact similarity) for the top `rerank`
+        candidates, highest similarity first
+    """
+    if len(gallery_encodings) == 0:
+        return []
+
+    query_compact = projection.transform([query_encoding])[0]
+    approx = gallery_compact @ query_compact
+
+    rerank = min(rerank, len(approx))
+    candidates = np.argpartition(-approx, rerank - 1)[:rerank]
+
+    # Re-score the surviving candidates with the full vectors
+    scored = [
+        (int(i), compare_face_encodings(gallery_encodings[i], query_encoding))
+        for i in candidates
+    ]
+    scored.sort(key=lambda item: item[1], reverse=True)
+    return scored
+
+
+def compare(gallery: List[List[float]], n_queries: int = 100, k: int = 5,
+            dims: Sequence[int] = (64, 96, 128), rerank: int = PROJECTION_RERANK,
+            noise: float = 0.05, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Compare projected matching against exact compare_face_encodings scoring
+
+    Queries are noisy copies of gallery vectors. Reports recall@k of the
+    compact-only ranking and the re-ranked ranking plus per-query latency.
+    """
+    rng = np.random.default_rng(seed)
+    full = to_matrix(gallery)
+    query_ids = rng.choice(len(gallery), size=min(n_queries, len(gallery)), replace=False)
+    queries = [
+        list(full[i] * (1 + noise * rng.standard_normal(full.shape[1])))
+        for i in query_ids
+    ]
+
+    # Baseline: the per-face loop used by recognize_face
+    start = time.perf_counter()
+    exact_top = []
+    for query in queries:
+        scores = np.array([compare_face_encodings(g, query) for g in gallery])
+        exact_top.append(set(np.argsort(-scores)[:k].tolist()))
+    baseline_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = [{"method": "exact", "dim": full.shape[1], "ms_per_query": baseline_ms,
+               "recall_at_k": 1.0, "reranked_recall_at_k": 1.0}]
+
+    for method in ("pca", "random"):
+        for dim in dims:
+            if method == "pca":
+                projection = fit_pca(gallery, dim)
+            else:
+                projection = fit_random_projection(full.shape[1], dim, seed=seed)
+            gallery_compact = projection.transform(gallery)
+
+            approx_hits = 0
+            reranked_hits = 0
+            start = time.perf_counter()
+            for query, expected in zip(queries, exact_top):
+                results = search(projection, query, gallery, gallery_compact, rerank)
+                reranked_hits += len(expected & {i for i, _ in results[:k]})
+            elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+            queries_compact = projection.transform(queries)
+            for query_compact, expected in zip(queries_compact, exact_top):
+                approx_top = np.argsort(-(gallery_compact @ query_compact))[:k]
+                approx_hits += len(expected & set(approx_top.tolist()))
+
+            report.append({
+                "method": method,
+                "dim": projection.output_dim,
+                "ms_per_query": elapsed_ms,
+                "recall_at_k": approx_hits / (k * len(queries)),
+                "reranked_recall_at_k": reranked_hits / (k * len(queries)),
+            })
+    return report
+
+
+async def _fit_and_store(method: str, dim: int, directory: str) -> Projection:
+    import db
+
+    faces = await db.find_all_faces_for_comparison()
+    if not faces:
+        raise SystemExit("Gallery is empty, nothing to fit")
+
+    versions = list_versions(directory)
+    version = versions[-1] + 1 if versions else 1
+    encodings = [face["face_encoding"] for face in faces]
+    if method == "pca":
+        projection = fit_pca(encodings, dim, version)
+    else:
+        projection = fit_random_projection(len(encodings[0]), dim, version)
+    path = projection.save(directory)
+
+    # Backfill compact vectors so matching does not have to project the gallery
+    compact = projection.transform(encodings)
+    await db.set_compact_encodings(
+        [(face["_id"], vector.tolist()) for face, vector in zip(faces, compact)],
+        projection.version
+    )
+    print(f"Saved {method} projection v{version} ({projection.output_dim} dims) to {path}")
+    return projection
+
+
+async def _load_gallery() -> List[List[float]]:
+    import db
+
+    faces = await db.find_all_faces_for_comparison()
+    return [face["face_encoding"] for face in faces]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit and evaluate encoding projections")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    fit = sub.add_parser("fit", help="Fit a projection on the stored gallery")
+    fit.add_argument("--method", choices=["pca", "random"], default="pca")
+    fit.add_argument("--dim", type=int, default=PROJECTION_DIM)
+    fit.add_argument("--dir", default=PROJECTION_DIR)
+
+    cmp_parser = sub.add_parser("compare", help="Accuracy/latency against exact matching")
+    cmp_parser.add_argument("--synthetic", type=int, default=0,
+                            help="Use N synthetic encodings instead of the stored gallery")
+    cmp_parser.add_argument("--queries", type=int, default=100)
+    cmp_parser.add_argument("--k", type=int, default=5)
+    cmp_parser.add_argument("--rerank", type=int, default=PROJECTION_RERANK)
+
+    args = parser.parse_args()
+
+    if args.command == "fit":
+        asyncio.run(_fit_and_store(args.method, args.dim, args.dir))
+        return
+
+    if args.synthetic:
+        # Smooth block statistics roughly shaped like extract_face_encoding output
+        rng = np.random.default_rng(0)
+        base = rng.uniform(60, 200, size=(args.synthetic, 20))
+        gallery = np.repeat(base, 40, axis=1) + rng.normal(0, 15, size=(args.synthetic, 800))
+        gallery = gallery.tolist()
+    else:
+        gallery = asyncio.run(_load_gallery())
+
+    for row in compare(gallery, args.queries, args.k, rerank=args.rerank):
+        print(f"{row['method']:>7} dim={row['dim']:<4} {row['ms_per_query']:8.3f} ms/query  "
+              f"recall@{args.k}={row['recall_at_k']:.3f}  "
+              f"reranked={row['reranked_recall_at_k']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+import argparse
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from face_utils import compare_face_encodings
+from projection import to_matrix
+
+# Quantized gallery configuration
+USE_QUANTIZED_GALLERY = os.getenv("USE_QUANTIZED_GALLERY", "false").lower() == "true"
+QUANTIZED_RESCORE_K = int(os.getenv("QUANTIZED_RESCORE_K", "20"))
+QUANTIZED_CHUNK_ROWS = int(os.getenv("QUANTIZED_CHUNK_ROWS", "65536"))
+# Minimum seconds between reloads triggered by other workers' gallery writes
+QUANTIZED_REFRESH_SECONDS = float(os.getenv("QUANTIZED_REFRESH_SECONDS", "30"))
+QUANTIZED_DIM = 800
+
+# Fields the serving index loads; float encodings stay in MongoDB
+QUANTIZED_PROJECTION = {"name": 1, "registration_timestamp": 1,
+                        "quantized_encoding": 1, "quant_scale": 1, "quant_offset": 1}
+
+
+def quantize_encodings(encodings: Sequence[Sequence[float]],
+                       dim: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Quantize encodings to uint8 with a per-vector scale and offset
+
+    Each vector is mapped so that x ~= scale * q + offset.
+
+    Returns:
+        (codes as uint8 matrix, scales, offsets)
+    """
+    full = to_matrix(encodings, dim)
+    offsets = full.min(axis=1)
+    scales = (full.max(axis=1) - offsets) / 255.0
+    scales[scales == 0] = 1.0
+    codes = np.rint((full - offsets[:, None]) / scales[:, None])
+    return (
+        np.clip(codes, 0, 255).astype(np.uint8),
+        scales.astype(np.float32),
+        offsets.astype(np.float32),
+    )
+
+
+def quantized_fields(encoding: Sequence[float]) -> Dict[str, Any]:
+    """Quantized representation of one encoding, ready to store in a face document"""
+    codes, scales, offsets = quantize_encodings([encoding])
+    return {
+        "quantized_encoding": codes[0].tobytes(),
+        "quant_scale": float(scales[0]),
+        "quant_offset": float(offsets[0]),
+    }
+
+
+class QuantizedGallery:
+    """
+    uint8 gallery matrix searched with integer dot products
+
+    Cosine similarity is recovered from the integer dot product of the
+    codes using the per-vector scale/offset terms and precomputed code sums
+    and norms, so the float vectors never need to be materialized.
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray, offsets: np.ndarray):
+        self.codes = codes
+        self.scales = scales.astype(np.float64)
+        self.offsets = offsets.astype(np.float64)
+        self.dim = codes.shape[1]
+
+        # Per-vector terms needed to expand (s*q + o) . (s'*q' + o')
+        self.code_sums = codes.sum(axis=1, dtype=np.int64).astype(np.float64)
+        code_squares = np.einsum("ij,ij->i", codes.astype(np.int32), codes.astype(np.int32)).astype(np.float64)
+        squared_norms = (self.scales ** 2 * code_squares
+                         + 2 * self.scales * self.offsets * self.code_sums
+                         + self.dim * self.offsets ** 2)
+        self.norms = np.sqrt(np.maximum(squared_norms, 0.0))
+
+    @classmethod
+    def from_encodings(cls, encodings: Sequence[Sequence[float]], dim: Optional[int] = None) -> "QuantizedGallery":
+        return cls(*quantize_encodings(encodings, dim))
+
+    @classmethod
+    def from_documents(cls, faces: List[Dict[str, Any]], dim: Optional[int] = None) -> "QuantizedGallery":
+        """Build from face documents, reusing quantized fields stored at registration"""
+        if dim is None:
+            dim = max((len(face["face_encoding"]) for face in faces), default=0)
+        codes = np.zeros((len(faces), dim), dtype=np.uint8)
+        scales = np.ones(len(faces), dtype=np.float32)
+        offsets = np.zeros(len(faces), dtype=np.float32)
+
+        missing = []
+        for i, face in enumerate(faces):
+            stored = face.get("quantized_encoding")
+            if stored is not None and len(stored) == dim:
+                codes[i] = np.frombuffer(stored, dtype=np.uint8)
+                scales[i] = face["quant_scale"]
+                offsets[i] = face["quant_offset"]
+            else:
+                missing.append(i)
+
+        if missing:
+            codes[missing], scales[missing], offsets[missing] = quantize_encodings(
+                [faces[i]["face_encoding"] for i in missing], dim
+            )
+        return cls(codes, scales, offsets)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def scores(self, query_encoding: Sequence[float]) -> np.ndarray:
+        """Approximate cosine similarity of the query against every gallery vector"""
+        q_codes, q_scales, q_offsets = quantize_encodings([query_encoding], self.dim)
+        q_code = q_codes[0].astype(np.int32)
+        q_scale = float(q_scales[0])
+        q_offset = float(q_offsets[0])
+        q_sum = float(q_code.sum())
+        q_norm = np.sqrt(max(q_scale ** 2 * float(q_code @ q_code)
+                             + 2 * q_scale * q_offset * q_sum
+                             + self.dim * q_offset ** 2, 0.0))
+
+        # Integer dot products, chunked so the int32 copy stays small
+        dots = np.empty(len(self.codes), dtype=np.float64)
+        for start in range(0, len(self.codes), QUANTIZED_CHUNK_ROWS):
+            chunk = self.codes[start:start + QUANTIZED_CHUNK_ROWS].astype(np.int32)
+            dots[start:start + len(chunk)] = chunk @ q_code
+
+        products = (self.scales * q_scale * dots
+                    + self.scales * q_offset * self.code_sums
+                    + self.offsets * q_scale * q_sum
+                    + self.dim * self.offsets * q_offset)
+        denominators = self.norms * q_norm
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(denominators > 0, products / denominators, 0.0)
+
+    def search(self, query_encoding: Sequence[float], k: int,
+               full_encodings: Optional[Sequence[Sequence[float]]] = None,
+               rescore_k: int = QUANTIZED_RESCORE_K) -> List[Tuple[int, float]]:
+        """
+        Top-k gallery indices by quantized similarity
+
+        When full_encodings is given, the best max(k, rescore_k) candidates are
+        re-scored exactly with compare_face_encodings before the final cut.
+        """
+        if len(self.codes) == 0:
+            return []
+
+        approx = self.scores(query_encoding)
+        n_candidates = min(len(approx), max(k, rescore_k) if full_encodings is not None else k)
+        candidates = np.argpartition(-approx, n_candidates - 1)[:n_candidates]
+
+        if full_encodings is not None:
+            scored = [(int(i), compare_face_encodings(full_encodings[i], query_encoding)) for i in candidates]
+        else:
+            scored = [(int(i), float(approx[i])) for i in candidates]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:k]
+
+    def memory_report(self) -> Dict[str, Any]:
+        """Bytes held by the quantized gallery against a float64 matrix of the same shape"""
+        quantized_bytes = (self.codes.nbytes + self.scales.nbytes + self.offsets.nbytes
+                           + self.code_sums.nbytes + self.norms.nbytes)
+        float_bytes = self.codes.size * np.dtype(np.float64).itemsize
+        return {
+            "faces": len(self.codes),
+            "dim": self.dim,
+            "quantized_bytes": int(quantized_bytes),
+            "float64_bytes": int(float_bytes),
+            "compression": float_bytes / quantized_bytes if quantized_bytes else 0.0,
+        }
+
+
+class QuantizedIndex:
+    """
+    Long-lived quantized gallery that serves matches in the app
+
+    Only the uint8 codes and the ID, name and timestamp reported per match
+    are held in memory. Float encodings are fetched by _id for the
+    re-scored candidates alone; faces stored without quantized fields are
+    quantized once at load and the fields written back.
+
+    The index is a list of segments: the loaded gallery plus one small
+    segment of local registrations, so adding a face never copies the
+    gallery. Writes from other workers are picked up by a background
+    reload once the shared gallery version has moved, at most every
+    refresh_seconds; the previous segments serve until it completes.
+    """
+
+    def __init__(self, dim: int = QUANTIZED_DIM, refresh_seconds: float = QUANTIZED_REFRESH_SECONDS):
+        self.dim = dim
+        self.refresh_seconds = refresh_seconds
+        # (gallery, [(face ID, name, registration timestamp), ...]) per segment
+        self._segments: List[Tuple[QuantizedGallery, List[tuple]]] = []
+        self.loaded_version: Optional[int] = None
+        self._loaded_at = 0.0
+        self._reloading = False
+
+    def __len__(self) -> int:
+        return sum(len(gallery) for gallery, _ in self._segments)
+
+    async def load(self, batch_size: int = 1000) -> int:
+        """Load the stored codes from MongoDB, replacing every segment"""
+        import db
+
+        # Read first, so writes that land mid-load trigger another reload
+        shared_version, _ = await db.current_gallery_version()
+        loop = asyncio.get_running_loop()
+        code_chunks, scales, offsets, records, missing = [], [], [], [], []
+        async for faces in db.stream_faces(QUANTIZED_PROJECTION, batch_size):
+            for face in faces:
+                stored = face.get("quantized_encoding")
+                if stored is None or len(stored) != self.dim:
+                    missing.append(str(face["_id"]))
+                    continue
+                code_chunks.append(bytes(stored))
+                scales.append(face["quant_scale"])
+                offsets.append(face["quant_offset"])
+                records.append((str(face["_id"]), face["name"], face.get("registration_timestamp")))
+
+        for start in range(0, len(missing), batch_size):
+            faces = await db.find_faces_by_ids(
+                missing[start:start + batch_size],
+                {"name": 1, "registration_timestamp": 1, "face_encoding": 1}
+            )
+            fields = await loop.run_in_executor(
+                None, lambda: [quantized_fields(face["face_encoding"]) for face in faces]
+            )
+            await db.set_quantized_encodings([(face["_id"], field) for face, field in zip(faces, fields)])
+            for face, field in zip(faces, fields):
+                code_chunks.append(field["quantized_encoding"])
+                scales.append(field["quant_scale"])
+                offsets.append(field["quant_offset"])
+                records.append((face["_id"], face["name"], face.get("registration_timestamp")))
+
+        def build():
+            codes = np.frombuffer(b"".join(code_chunks), dtype=np.uint8).reshape(-1, self.dim)
+            return QuantizedGallery(codes, np.asarray(scales, dtype=np.float32),
+                                    np.asarray(offsets, dtype=np.float32))
+
+        gallery = await loop.run_in_executor(None, build)
+        self._segments = [(gallery, records)]
+        self.loaded_version = shared_version
+        self._loaded_at = time.monotonic()
+        # Results cached against the previous index must not be reused
+        db.bump_gallery_version()
+        return len(records)
+
+    def add(self, faces: List[Dict[str, Any]]) -> None:
+        """Append faces registered by this worker; they need the quantized fields"""
+        if not faces:
+            return
+        codes = np.frombuffer(b"".join(bytes(face["quantized_encoding"]) for face in faces),
+                              dtype=np.uint8).reshape(-1, self.dim)
+        scales = np.asarray([face["quant_scale"] for face in faces], dtype=np.float32)
+        offsets = np.asarray([face["quant_offset"] for face in faces], dtype=np.float32)
+        records = [(str(face["_id"]), face["name"], face.get("registration_timestamp")) for face in faces]
+
+        segments = list(self._segments)
+        if len(segments) > 1:
+            # Merge into the local segment, which stays small between reloads
+            recent, recent_records = segments.pop()
+            codes = np.concatenate([recent.codes, codes])
+            scales = np.concatenate([recent.scales.astype(np.float32), scales])
+            offsets = np.concatenate([recent.offsets.astype(np.float32), offsets])
+            records = recent_records + records
+        segments.append((QuantizedGallery(codes, scales, offsets), records))
+        self._segments = segments
+
+    def maybe_reload(self, shared_version: int) -> Optional[asyncio.Task]:
+        """Start a background reload if another worker changed the gallery and the index is due"""
+        import db
+
+        if self._reloading or shared_version == self.loaded_version:
+            return None
+        if not db.changed_elsewhere(self.loaded_version, shared_version):
+            # Only this worker's own registrations, already applied
+            self.loaded_version = shared_version
+            return None
+        if time.monotonic() - self._loaded_at < self.refresh_seconds:
+            return None
+
+        async def reload():
+            self._reloading = True
+            try:
+                await self.load()
+            finally:
+                self._reloading = False
+
+        return asyncio.create_task(reload())
+
+    def _candidates(self, query_encodings: Sequence[Sequence[float]], n: int) -> List[List[Tuple[float, tuple]]]:
+        segments = self._segments
+        results = []
+        for query in query_encodings:
+            candidates = [
+                (score, records[index])
+                for gallery, records in segments
+                for index, score in gallery.search(query, n)
+            ]
+            candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+            results.append(candidates[:n])
+        return results
+
+    async def asearch(self, query_encodings: Sequence[Sequence[float]], k: int, threshold: float = -1.0,
+                      rescore_k: int = QUANTIZED_RESCORE_K) -> List[List[Dict[str, Any]]]:
+        """
+        Top-k matches for each query encoding
+
+        With rescore_k > 0, the best max(k, rescore_k) candidates per query
+        are re-scored exactly against float encodings fetched in one query.
+
+        Returns:
+            For each query, up to k match dicts sorted by similarity
+        """
+        import db
+
+        loop = asyncio.get_running_loop()
+        n = max(k, rescore_k) if rescore_k > 0 else k
+        candidates = await loop.run_in_executor(None, self._candidates, query_encodings, n)
+
+        if rescore_k > 0:
+            face_ids = list({record[0] for per_query in candidates for _, record in per_query})
+            encodings = {
+                face["_id"]: face["face_encoding"]
+                for face in await db.find_faces_by_ids(face_ids, {"face_encoding": 1})
+            }
+            candidates = [
+                sorted(
+                    ((compare_face_encodings(encodings[record[0]], query), record)
+                     for _, record in per_query if record[0] in encodings),
+                    key=lambda candidate: candidate[0], reverse=True
+                )
+                for query, per_query in zip(query_encodings, candidates)
+            ]
+
+        return [
+            [
+                {"id": face_id, "name": name, "similarity": float(score), "registration_timestamp": timestamp}
+                for score, (face_id, name, timestamp) in per_query[:k]
+                if score >= threshold
+            ]
+            for per_query in candidates
+        ]
+
+    def memory_report(self) -> Dict[str, Any]:
+        reports = [gallery.memory_report() for gallery, _ in self._segments]
+        return {
+            "faces": len(self),
+            "segments": len(reports),
+            "quantized_bytes": sum(report["quantized_bytes"] for report in reports),
+            "float64_bytes": sum(report["float64_bytes"] for report in reports),
+            "loaded_version": self.loaded_version,
+        }
+
+
+def compare(gallery: List[List[float]], n_queries: int = 100, k: int = 5,
+            rescore_k: int = QUANTIZED_RESCORE_K, noise: float = 0.05,
+            seed: int = 0) -> Dict[str, Any]:
+    """
+    Match quality and latency of the quantized gallery against float scoring
+
+    Queries are noisy copies of gallery vectors.
+    """
+    rng = np.random.default_rng(seed)
+    full = to_matrix(gallery)
+    normalized = full / np.maximum(np.linalg.norm(full, axis=1, keepdims=True), 1e-12)
+    quantized = QuantizedGallery.from_encodings(gallery)
+
+    query_ids = rng.choice(len(gallery), size=min(n_queries, len(gallery)), replace=False)
+    queries = [full[i] * (1 + noise * rng.standard_normal(full.shape[1])) for i in query_ids]
+
+    float_ms = quantized_ms = rescored_ms = 0.0
+    approx_hits = rescored_hits = 0
+    max_error = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        exact = normalized @ (query / np.linalg.norm(query))
+        expected = set(np.argsort(-exact)[:k].tolist())
+        float_ms += (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        approx = quantized.search(query, k)
+        quantized_ms += (time.perf_counter() - start) * 1000
+        approx_hits += len(expected & {i for i, _ in approx})
+
+        start = time.perf_counter()
+        rescored = quantized.search(query, k, full_encodings=gallery, rescore_k=rescore_k)
+        rescored_ms += (time.perf_counter() - start) * 1000
+        rescored_hits += len(expected & {i for i, _ in rescored})
+
+        max_error = max(max_error, float(np.abs(quantized.scores(query) - exact).max()))
+
+    n = len(queries)
+    return {
+        **quantized.memory_report(),
+        "float_ms_per_query": float_ms / n,
+        "quantized_ms_per_query": quantized_ms / n,
+        "rescored_ms_per_query": rescored_ms / n,
+        "recall_at_k": approx_hits / (k * n),
+        "rescored_recall_at_k": rescored_hits / (k * n),
+        "max_abs_score_error": max_error,
+    }
+
+
+async def _load_gallery() -> List[List[float]]:
+    import db
+
+    faces = await db.find_all_faces_for_comparison()
+    return [face["face_encoding"] for face in faces]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the int8 quantized gallery")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Use N synthetic encodings instead of the stored gallery")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--rescore-k", type=int, default=QUANTIZED_RESCORE_K)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        base = rng.uniform(60, 200, size=(args.synthetic, 20))
+        gallery = np.repeat(base, 40, axis=1) + rng.normal(0, 15, size=(args.synthetic, 800))
+        gallery = gallery.tolist()
+    else:
+        gallery = asyncio.run(_load_gallery())
+
+    for key, value in compare(gallery, args.queries, args.k, args.rescore_k).items():
+        print(f"{key:>24}: {value:.4f}" if isinstance(value, float) else f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    main()
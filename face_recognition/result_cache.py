@@ -0,0 +1,128 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+# Memory budgets for the two caches (in megabytes)
+FEATURE_CACHE_MAX_MB = float(os.getenv("FEATURE_CACHE_MAX_MB", "64"))
+MATCH_CACHE_MAX_MB = float(os.getenv("MATCH_CACHE_MAX_MB", "16"))
+# Upper bound on how long a match response is reused, covering gallery
+# writes that bypass db.py and so never bump the shared version
+MATCH_CACHE_TTL_SECONDS = float(os.getenv("MATCH_CACHE_TTL_SECONDS", "300"))
+
+
+def content_digest(contents: bytes) -> str:
+    """Return the hex SHA-256 digest used as cache key for an uploaded image"""
+    return hashlib.sha256(contents).hexdigest()
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Roughly estimate the memory footprint of a cached value in bytes
+
+    Walks dicts, lists and tuples; numpy arrays report their buffer size.
+    """
+    nbytes = getattr(value, "nbytes", None)
+    if nbytes is not None:
+        return int(nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimate_size(k) + estimate_size(v) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache bounded by the estimated size of its entries
+
+    Entries may be tagged with a version; a lookup with a different version,
+    or after max_age seconds, is treated as a miss and drops the stale entry.
+    """
+
+    def __init__(self, name: str, max_bytes: int, max_age: Optional[float] = None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable, version: Optional[Hashable] = None) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, entry_version, size, created = entry
+            expired = self.max_age is not None and time.monotonic() - created > self.max_age
+            if entry_version != version or expired:
+                # Entry was computed against an older gallery
+                del self._entries[key]
+                self.current_bytes -= size
+                self.invalidations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, version: Optional[Hashable] = None) -> None:
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[2]
+
+            self._entries[key] = (value, version, size, time.monotonic())
+            self.current_bytes += size
+
+            # Evict least recently used entries until we fit the budget
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, evicted_size, _) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "max_age_seconds": self.max_age,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+# Detection + encoding results keyed by image digest
+feature_cache = ResultCache("features", int(FEATURE_CACHE_MAX_MB * 1024 * 1024))
+
+# Full match responses keyed by image digest and request parameters,
+# tagged with the gallery version they were computed against
+match_cache = ResultCache(
+    "matches", int(MATCH_CACHE_MAX_MB * 1024 * 1024), max_age=MATCH_CACHE_TTL_SECONDS or None
+)
@@ -0,0 +1,306 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Sharding configuration
+USE_SHARDED_GALLERY = os.getenv("USE_SHARDED_GALLERY", "false").lower() == "true"
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1)))
+SHARD_DIM = 800
+# Fields each shard keeps per face
+SHARD_PROJECTION = {"name": 1, "face_encoding": 1, "registration_timestamp": 1}
+# Held by the worker that owns the shard pool; a second worker fails to start
+SHARD_LOCK_FILE = os.getenv("SHARD_LOCK_FILE", "shards.lock")
+# Minimum seconds between reloads triggered by writes from other processes
+SHARD_REFRESH_SECONDS = float(os.getenv("SHARD_REFRESH_SECONDS", "30"))
+
+
+def shard_for(face_id: str, num_shards: int) -> int:
+    """Stable shard assignment by hash of the face ID"""
+    return zlib.crc32(str(face_id).encode("utf-8")) % num_shards
+
+
+def _normalize(encoding: Sequence[float], dim: int = SHARD_DIM) -> np.ndarray:
+    vector = np.zeros(dim, dtype=np.float32)
+    values = np.asarray(encoding, dtype=np.float32)[:dim]
+    vector[:len(values)] = values
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class _Shard:
+    """Gallery partition held by one worker process"""
+
+    def __init__(self, dim: int = SHARD_DIM):
+        self.dim = dim
+        self.records: List[Tuple[str, str, Any]] = []
+        self.positions: Dict[str, int] = {}
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self._pending: List[np.ndarray] = []
+
+    def insert(self, records: List[Tuple[str, str, Any, Sequence[float]]]) -> int:
+        for face_id, name, timestamp, encoding in records:
+            if face_id in self.positions:
+                continue
+            self.positions[face_id] = len(self.records)
+            self.records.append((face_id, name, timestamp))
+            self._pending.append(_normalize(encoding, self.dim))
+        return len(self.records)
+
+    def delete(self, face_id: str) -> bool:
+        self._flush()
+        index = self.positions.pop(face_id, None)
+        if index is None:
+            return False
+        # Move the last row into the freed slot
+        last = len(self.records) - 1
+        if index != last:
+            self.records[index] = self.records[last]
+            self.matrix[index] = self.matrix[last]
+            self.positions[self.records[index][0]] = index
+        self.records.pop()
+        self.matrix = self.matrix[:last]
+        return True
+
+    def _flush(self) -> None:
+        if self._pending:
+            self.matrix = np.vstack([self.matrix, np.stack(self._pending)])
+            self._pending = []
+
+    def search(self, queries: np.ndarray, k: int, threshold: float) -> List[List[Tuple]]:
+        self._flush()
+        results = []
+        if len(self.records) == 0:
+            return [[] for _ in queries]
+
+        scores = queries @ self.matrix.T
+        k = min(k, len(self.records))
+        for row in scores:
+            top = np.argpartition(-row, k - 1)[:k]
+            results.append([
+                (float(row[i]),) + self.records[i]
+                for i in top if row[i] >= threshold
+            ])
+        return results
+
+
+def _shard_main(conn, dim: int) -> None:
+    """
+    Worker loop: apply commands to the local shard until told to stop
+
+    A reload fills a staging shard that replaces the live one on "swap";
+    inserts and deletes arriving meanwhile are applied to both.
+    """
+    shard = _Shard(dim)
+    staging: Optional[_Shard] = None
+    while True:
+        command, payload = conn.recv()
+        if command == "stop":
+            conn.send(None)
+            break
+        try:
+            if command == "insert":
+                if staging is not None:
+                    staging.insert(payload)
+                conn.send(shard.insert(payload))
+            elif command == "delete":
+                if staging is not None:
+                    staging.delete(payload)
+                conn.send(shard.delete(payload))
+            elif command == "begin":
+                staging = _Shard(dim)
+                conn.send(None)
+            elif command == "stage":
+                conn.send(staging.insert(payload))
+            elif command == "swap":
+                shard, staging = staging, None
+                conn.send(len(shard.records))
+            elif command == "search":
+                conn.send(shard.search(*payload))
+            elif command == "size":
+                conn.send(len(shard.records))
+            else:
+                conn.send(ValueError(f"Unknown shard command: {command}"))
+        except Exception as e:
+            conn.send(e)
+
+
+class ShardedGallery:
+    """
+    Gallery partitioned across local worker processes
+
+    Every query is scattered to all shards, which compute top-k over their
+    partition in parallel; the front end merges the partial results.
+
+    The pool belongs to one uvicorn worker: start() takes an exclusive lock
+    on SHARD_LOCK_FILE and fails if another worker holds it, since shards
+    are not shared between workers. Writes made by other processes (other
+    hosts, the importer) are picked up by reloading from MongoDB once the
+    shared gallery version has moved, at most every refresh_seconds.
+    """
+
+    def __init__(self, num_shards: int = SHARD_WORKERS, dim: int = SHARD_DIM,
+                 lock_file: str = SHARD_LOCK_FILE, refresh_seconds: float = SHARD_REFRESH_SECONDS):
+        self.num_shards = max(1, num_shards)
+        self.dim = dim
+        self.lock_file = lock_file
+        self.refresh_seconds = refresh_seconds
+        self.loaded_version: Optional[int] = None
+        self._loaded_at = 0.0
+        self._reloading = False
+        self._owner_lock = None
+        self._connections = []
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        import fcntl
+
+        owner_lock = open(self.lock_file, "w")
+        try:
+            fcntl.flock(owner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            owner_lock.close()
+            raise RuntimeError(
+                f"{self.lock_file} is held by another worker; USE_SHARDED_GALLERY needs a single "
+                "uvicorn worker (run with --workers 1)"
+            )
+        self._owner_lock = owner_lock
+
+        context = multiprocessing.get_context("spawn")
+        for _ in range(self.num_shards):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_shard_main, args=(child_conn, self.dim), daemon=True)
+            process.start()
+            self._connections.append(parent_conn)
+            self._processes.append(process)
+
+    def stop(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.send(("stop", None))
+                conn.recv()
+        for process in self._processes:
+            process.join(timeout=5)
+        self._connections = []
+        self._processes = []
+        if self._owner_lock is not None:
+            self._owner_lock.close()
+            self._owner_lock = None
+
+    def _scatter(self, messages: Dict[int, Tuple[str, Any]]) -> Dict[int, Any]:
+        """Send one message per shard, then collect the replies"""
+        with self._lock:
+            for shard, message in messages.items():
+                self._connections[shard].send(message)
+            replies = {shard: self._connections[shard].recv() for shard in messages}
+
+        for reply in replies.values():
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def insert(self, faces: Iterable[Dict[str, Any]], command: str = "insert") -> None:
+        """Route face documents to their shards"""
+        batches: Dict[int, List[Tuple]] = {}
+        for face in faces:
+            face_id = str(face["_id"])
+            batches.setdefault(shard_for(face_id, self.num_shards), []).append(
+                (face_id, face["name"], face.get("registration_timestamp"), face["face_encoding"])
+            )
+        if batches:
+            self._scatter({shard: (command, batch) for shard, batch in batches.items()})
+
+    def delete(self, face_id: str) -> bool:
+        shard = shard_for(face_id, self.num_shards)
+        return self._scatter({shard: ("delete", str(face_id))})[shard]
+
+    def size(self) -> int:
+        replies = self._scatter({shard: ("size", None) for shard in range(self.num_shards)})
+        return sum(replies.values())
+
+    def search(self, query_encodings: Sequence[Sequence[float]], k: int,
+               threshold: float = -1.0) -> List[List[Dict[str, Any]]]:
+        """
+        Top-k matches for each query encoding across all shards
+
+        Returns:
+            For each query, up to k match dicts sorted by similarity
+        """
+        queries = np.stack([_normalize(encoding, self.dim) for encoding in query_encodings])
+        replies = self._scatter({
+            shard: ("search", (queries, k, threshold)) for shard in range(self.num_shards)
+        })
+
+        merged = []
+        for query_index in range(len(queries)):
+            candidates = [match for reply in replies.values() for match in reply[query_index]]
+            candidates.sort(key=lambda match: match[0], reverse=True)
+            merged.append([
+                {"id": face_id, "name": name, "similarity": score, "registration_timestamp": timestamp}
+                for score, face_id, name, timestamp in candidates[:k]
+            ])
+        return merged
+
+    async def asearch(self, query_encodings: Sequence[Sequence[float]], k: int,
+                      threshold: float = -1.0) -> List[List[Dict[str, Any]]]:
+        """search() without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.search, query_encodings, k, threshold)
+
+    async def load_from_db(self, batch_size: int = 1000) -> int:
+        """
+        Stream the gallery from MongoDB into fresh shards and swap them in
+
+        The current shards keep serving until every shard has its new partition.
+        """
+        import db
+
+        # Read first, so writes that land mid-load trigger another reload
+        shared_version, _ = await db.current_gallery_version()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, self._scatter, {shard: ("begin", None) for shard in range(self.num_shards)}
+        )
+        total = 0
+        async for faces in db.stream_faces(SHARD_PROJECTION, batch_size):
+            await loop.run_in_executor(None, self.insert, faces, "stage")
+            total += len(faces)
+        await loop.run_in_executor(
+            None, self._scatter, {shard: ("swap", None) for shard in range(self.num_shards)}
+        )
+        self.loaded_version = shared_version
+        self._loaded_at = time.monotonic()
+        # Results cached against the previous shards must not be reused
+        db.bump_gallery_version()
+        return total
+
+    def maybe_reload(self, shared_version: int) -> Optional[asyncio.Task]:
+        """Start a background reload if the gallery changed elsewhere and the shards are due"""
+        import db
+
+        if self._reloading or shared_version == self.loaded_version:
+            return None
+        if not db.changed_elsewhere(self.loaded_version, shared_version):
+            # Only this worker's own registrations, already applied
+            self.loaded_version = shared_version
+            return None
+        if time.monotonic() - self._loaded_at < self.refresh_seconds:
+            return None
+
+        async def reload():
+            self._reloading = True
+            try:
+                await self.load_from_db()
+            finally:
+                self._reloading = False
+
+        return asyncio.create_task(reload())
+
+
+sharded_gallery: Optional[ShardedGallery] = ShardedGallery() if USE_SHARDED_GALLERY else None
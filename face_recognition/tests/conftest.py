@@ -0,0 +1,29 @@
+import asyncio
+import os
+import sys
+
+import mongomock_motor
+import pytest
+
+# The service modules are imported top-level, as uvicorn runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """Point db at a fresh mongomock database"""
+    client = mongomock_motor.AsyncMongoMockClient()
+    database = client.face_recognition
+    monkeypatch.setattr(db, "client", client)
+    monkeypatch.setattr(db, "db", database)
+    monkeypatch.setattr(db, "face_collection", database.faces)
+    monkeypatch.setattr(db, "tombstone_collection", database.face_tombstones)
+    monkeypatch.setattr(db, "meta_collection", database.gallery_meta)
+    monkeypatch.setattr(db, "gallery_version", 0)
+    return database
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
@@ -0,0 +1,50 @@
+import asyncio
+
+from admission import AdmissionController, AdmissionMiddleware, begin_write, check_deadline
+
+DEADLINE_HEADERS = [(b"x-request-deadline-ms", b"50")]
+
+
+def handler(events, write):
+    async def app(scope, receive, send):
+        check_deadline()
+        if write:
+            begin_write()
+        events.append("started")
+        await asyncio.sleep(0.2)
+        events.append("finished")
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+    return app
+
+
+def call(app):
+    middleware = AdmissionMiddleware(app, AdmissionController(), {"/register-face": 1})
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/register-face", "headers": DEADLINE_HEADERS}
+    asyncio.run(middleware(scope, None, send))
+    return sent[0]["status"], middleware.controller.stats()
+
+
+def test_expired_request_is_cancelled_with_503():
+    events = []
+    status, stats = call(handler(events, write=False))
+
+    assert status == 503
+    assert events == ["started"]
+    assert stats["lanes"]["bulk"]["expired_in_flight"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_request_past_begin_write_runs_to_completion():
+    events = []
+    status, stats = call(handler(events, write=True))
+
+    assert status == 200
+    assert events == ["started", "finished"]
+    assert stats["lanes"]["bulk"]["expired_in_flight"] == 0
+    assert stats["in_flight"] == 0
@@ -0,0 +1,266 @@
+import re
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+import db
+from conftest import run
+
+
+def make_face(name, timestamp, **fields):
+    return {
+        "name": name,
+        "face_encoding": [0.5, 1.5, 2.5],
+        "face_image_base64": "aW1hZ2U=",
+        "additional_info": {"team": "blue"},
+        "registration_timestamp": timestamp,
+        **fields,
+    }
+
+
+def test_insert_faces_returns_ids_and_stamps_documents(mongo):
+    start = datetime(2024, 1, 1)
+    ids = run(db.insert_faces([make_face(f"face{i}", start + timedelta(seconds=i)) for i in range(3)]))
+
+    assert len(ids) == 3
+    stored = run(mongo.faces.find({}).to_list(None))
+    assert sorted(str(face["_id"]) for face in stored) == sorted(ids)
+    assert all(isinstance(face["synced_at"], datetime) for face in stored)
+    assert run(db.current_gallery_version()) == (1, 1)
+
+
+def test_insert_face_is_stamped_in_the_same_write(mongo, monkeypatch):
+    async def no_second_write(*args):
+        raise AssertionError("insert_face should not stamp in a separate write")
+
+    monkeypatch.setattr(db, "_stamp_synced", no_second_write)
+    face = make_face("face", datetime(2024, 1, 1))
+    face_id = run(db.insert_face(face))
+
+    stored = run(mongo.faces.find_one({"_id": ObjectId(face_id)}))
+    assert face["_id"] == stored["_id"]
+    assert stored["name"] == "face" and stored["face_encoding"] == [0.5, 1.5, 2.5]
+    assert isinstance(stored["synced_at"], datetime)
+    assert run(db.current_gallery_version()) == (1, 1)
+
+
+def test_insert_faces_empty_is_a_no_op(mongo):
+    assert run(db.insert_faces([])) == []
+    assert run(db.current_gallery_version()) == (0, 0)
+
+
+def test_delete_faces_by_ids_records_tombstones(mongo):
+    ids = run(db.insert_faces([make_face(f"face{i}", datetime(2024, 1, 1)) for i in range(4)]))
+
+    deleted = run(db.delete_faces_by_ids(ids[:2] + ["not-an-id", str(ObjectId())]))
+
+    assert deleted == 2
+    remaining = run(mongo.faces.find({}).to_list(None))
+    assert sorted(str(face["_id"]) for face in remaining) == sorted(ids[2:])
+    tombstones = run(mongo.face_tombstones.find({}).to_list(None))
+    assert sorted(tombstone["face_id"] for tombstone in tombstones) == sorted(ids[:2])
+    assert all(isinstance(tombstone["synced_at"], datetime) for tombstone in tombstones)
+    assert all(isinstance(tombstone["deleted_at"], datetime) for tombstone in tombstones)
+
+
+def test_delete_without_matches_leaves_no_tombstones(mongo):
+    run(db.insert_faces([make_face("face", datetime(2024, 1, 1))]))
+    version = run(db.current_gallery_version())
+
+    assert run(db.delete_faces_by_ids([str(ObjectId()), "bad"])) == 0
+    assert run(db.delete_faces_by_ids([])) == 0
+    assert run(db.delete_face_by_id("bad")) is False
+    assert run(mongo.face_tombstones.count_documents({})) == 0
+    assert run(db.current_gallery_version()) == version
+
+
+def test_delete_face_by_id_records_tombstone(mongo):
+    [face_id] = run(db.insert_faces([make_face("face", datetime(2024, 1, 1))]))
+
+    assert run(db.delete_face_by_id(face_id)) is True
+    assert run(db.delete_face_by_id(face_id)) is False
+    assert run(mongo.face_tombstones.count_documents({"face_id": face_id})) == 1
+
+
+def test_page_cursor_round_trip():
+    face = {"_id": ObjectId(), "registration_timestamp": datetime(2024, 5, 6, 7, 8, 9, 123000)}
+
+    query = db.decode_page_cursor(db.encode_page_cursor(face))
+
+    assert query == {"$or": [
+        {"registration_timestamp": {"$lt": face["registration_timestamp"]}},
+        {"registration_timestamp": face["registration_timestamp"], "_id": {"$lt": face["_id"]}},
+    ]}
+
+
+def test_keyset_paging_across_equal_timestamps(mongo):
+    shared = datetime(2024, 1, 2)
+    timestamps = [datetime(2024, 1, 3), shared, shared, shared, shared, datetime(2024, 1, 1), datetime(2024, 1, 1)]
+    run(db.insert_faces([make_face(f"face{i}", timestamp) for i, timestamp in enumerate(timestamps)]))
+
+    pages, after = [], None
+    while True:
+        page = run(db.find_all_faces(limit=2, after=after))
+        pages.append(page["faces"])
+        after = page["next_cursor"]
+        if after is None:
+            break
+
+    seen = [face["_id"] for page in pages for face in page]
+    expected = sorted(
+        run(mongo.faces.find({}).to_list(None)),
+        key=lambda face: (face["registration_timestamp"], face["_id"]), reverse=True
+    )
+    assert seen == [str(face["_id"]) for face in expected]
+    assert len(set(seen)) == len(timestamps)
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+
+
+def test_keyset_paging_exact_multiple_ends_with_empty_page(mongo):
+    run(db.insert_faces([make_face(f"face{i}", datetime(2024, 1, 1)) for i in range(4)]))
+
+    first = run(db.find_all_faces(limit=2))
+    second = run(db.find_all_faces(limit=2, after=first["next_cursor"]))
+    last = run(db.find_all_faces(limit=2, after=second["next_cursor"]))
+
+    assert last["faces"] == [] and last["next_cursor"] is None
+    assert first["total"] is None
+    assert run(db.find_all_faces(limit=2, include_total=True))["total"] == 4
+
+
+def test_summary_projection_leaves_out_encodings_and_images(mongo):
+    ids = run(db.insert_faces([make_face("face", datetime(2024, 1, 1))]))
+
+    [listed] = run(db.find_all_faces(limit=10))["faces"]
+    [by_ids] = run(db.find_faces_by_ids(ids))
+
+    for face in (listed, by_ids):
+        assert set(face) == {"_id", "name", "additional_info", "registration_timestamp"}
+        assert isinstance(face["_id"], str)
+
+
+def test_custom_projections(mongo):
+    [face_id] = run(db.insert_faces([make_face("face", datetime(2024, 1, 1))]))
+
+    [encoding_only] = run(db.find_faces_by_ids([face_id], {"face_encoding": 1}))
+    assert set(encoding_only) == {"_id", "face_encoding"}
+
+    full = run(db.find_face_by_id(face_id))
+    assert full["face_image_base64"] == "aW1hZ2U=" and full["_id"] == face_id
+    assert set(run(db.find_face_by_id(face_id, {"name": 1}))) == {"_id", "name"}
+    assert run(db.find_face_by_id("bad")) is None
+    assert run(db.find_faces_by_ids(["bad"])) == []
+
+    [matching] = run(db.find_identity_templates(face_id))
+    assert "face_image_base64" not in matching and "additional_info" not in matching
+    assert matching["face_encoding"] == [0.5, 1.5, 2.5]
+
+
+class CollationStub:
+    """
+    Delegates to a mongomock collection, recording the collation passed
+
+    mongomock accepts but ignores collations and has no $text operator, so
+    case-insensitive matching and $text word search are emulated here.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collations = []
+
+    def _translate(self, query, collation):
+        self.collations.append(collation)
+        if "$text" in query:
+            words = query["$text"]["$search"].split()
+            return {"name": {"$regex": "|".join(rf"\b{re.escape(word)}\b" for word in words), "$options": "i"}}
+        if collation is None:
+            return query
+        condition = query["name"]
+        if isinstance(condition, str):
+            return {"name": {"$regex": f"^{re.escape(condition)}$", "$options": "i"}}
+        prefix = condition["$gte"]
+        assert condition["$lt"] == prefix + "\uffff"
+        return {"name": {"$regex": f"^{re.escape(prefix)}", "$options": "i"}}
+
+    def find(self, query, projection=None, collation=None):
+        return self.collection.find(self._translate(query, collation), projection)
+
+    async def count_documents(self, query, collation=None):
+        return await self.collection.count_documents(self._translate(query, collation))
+
+
+@pytest.fixture
+def named(mongo, monkeypatch):
+    run(db.insert_faces([
+        make_face(name, datetime(2024, 1, 1))
+        for name in ["Alice Smith", "alice jones", "Alicia Keys", "Bob Alice", "Carol"]
+    ]))
+    stub = CollationStub(mongo.faces)
+    monkeypatch.setattr(db, "face_collection", stub)
+    return stub
+
+
+def names(result):
+    return sorted(face["name"] for face in result["faces"])
+
+
+def test_exact_name_search_uses_collation(named):
+    result = run(db.search_faces_by_name("ALICE SMITH", mode="exact", include_total=True))
+
+    assert names(result) == ["Alice Smith"]
+    assert result["total"] == 1 and result["query"] == "ALICE SMITH"
+    assert named.collations == [db.NAME_COLLATION, db.NAME_COLLATION]
+
+
+def test_prefix_name_search_is_an_anchored_range(named):
+    result = run(db.search_faces_by_name("ali", mode="prefix"))
+
+    assert names(result) == ["Alice Smith", "Alicia Keys", "alice jones"]
+    assert result["total"] is None
+    assert named.collations == [db.NAME_COLLATION]
+
+
+def test_prefix_name_search_respects_limit(named):
+    result = run(db.search_faces_by_name("ali", limit=2, include_total=True))
+
+    assert len(result["faces"]) == 2 and result["total"] == 3
+
+
+def test_text_name_search_matches_words_without_collation(named):
+    result = run(db.search_faces_by_name("alice", mode="text"))
+
+    assert names(result) == ["Alice Smith", "Bob Alice", "alice jones"]
+    assert named.collations == [None]
+    assert set(result["faces"][0]) == {"_id", "name", "additional_info", "registration_timestamp"}
+
+
+def test_unknown_name_search_mode(named):
+    with pytest.raises(ValueError):
+        run(db.search_faces_by_name("alice", mode="fuzzy"))
+
+
+def test_identity_templates_resolve_any_template_to_its_root(mongo):
+    root_id, other_id = run(db.insert_faces([
+        make_face("ada", datetime(2024, 1, 1)), make_face("bob", datetime(2024, 1, 1))
+    ]))
+    template_ids = run(db.insert_faces([
+        make_face("ada", datetime(2024, 1, 2), identity_id=root_id) for _ in range(2)
+    ]))
+
+    for identity_id in [root_id] + template_ids:
+        templates = run(db.find_identity_templates(identity_id))
+        assert sorted(str(face["_id"]) for face in templates) == sorted([root_id] + template_ids)
+    assert [str(face["_id"]) for face in run(db.find_identity_templates(other_id))] == [other_id]
+    assert run(db.find_identity_templates(str(ObjectId()))) == []
+
+
+def test_only_unpublished_writes_count_as_changed_elsewhere(mongo, monkeypatch):
+    monkeypatch.setattr(db, "_published_changes", set())
+    run(db.insert_face(make_face("registered", datetime(2024, 1, 1))))
+    assert not db.changed_elsewhere(0, 1)
+
+    run(db.insert_faces([make_face("imported", datetime(2024, 1, 1))]))
+    assert db.changed_elsewhere(1, 2)
+    assert db.changed_elsewhere(0, 2)
+    assert db.changed_elsewhere(None, 1)
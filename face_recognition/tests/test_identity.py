@@ -0,0 +1,33 @@
+import numpy as np
+
+import db
+from conftest import run
+from identity import identity_of
+
+import app
+
+
+def encoding(seed):
+    return np.random.default_rng(seed).normal(size=64).tolist()
+
+
+def face_image():
+    return np.full((32, 32, 3), 128, dtype=np.uint8)
+
+
+def enroll(identity_id, seed):
+    return run(app._enroll_template(identity_id, "ada", face_image(), encoding(seed), {}))
+
+
+def test_enrolling_through_a_template_id_extends_the_root_identity(mongo):
+    root_id = run(db.insert_face({"name": "ada", "face_encoding": encoding(0)}))
+    template_id = enroll(root_id, 1)["id"]
+
+    response = enroll(template_id, 2)
+
+    assert response["identity_id"] == root_id
+    assert response["template_count"] == 3
+    faces = run(mongo.faces.find({}).to_list(None))
+    assert {identity_of(face) for face in faces} == {root_id}
+    root = next(face for face in faces if str(face["_id"]) == root_id)
+    assert root["identity_template_count"] == 3
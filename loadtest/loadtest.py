@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+import abc
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FACE_DIR = os.path.join(ROOT_DIR, "face_recognition")
+RAG_DIR = os.path.join(ROOT_DIR, "rag")
+
+QUESTIONS = [
+    "Who was registered most recently?",
+    "When was person_3 registered?",
+    "How many people are registered?",
+    "List the people registered today",
+    "Is there anyone named person_12?",
+]
+
+
+# ---------------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------------
+
+def synthetic_face(rng: np.random.Generator) -> np.ndarray:
+    """Cartoon face that the Haar cascade detects often enough to build a pool"""
+    import cv2
+
+    size = 240
+    img = np.full((size, size, 3), int(rng.integers(150, 230)), np.uint8)
+    cx = size // 2 + int(rng.integers(-10, 11))
+    cy = size // 2 + int(rng.integers(-10, 11))
+    skin = tuple(int(v) for v in rng.integers(110, 225, 3))
+    cv2.ellipse(img, (cx, cy + 5), (62, 80), 0, 0, 360, skin, -1)
+    for dx in (-25, 25):
+        cv2.ellipse(img, (cx + dx, cy - 15), (13, 7), 0, 0, 360, (40, 40, 40), -1)
+        cv2.line(img, (cx + dx - 16, cy - 32), (cx + dx + 14, cy - 32), (30, 30, 30), 4)
+    cv2.line(img, (cx, cy - 10), (cx - 5, cy + 25), (90, 90, 90), 3)
+    cv2.ellipse(img, (cx, cy + 45), (24, 9), 0, 0, 360, (60, 40, 120), -1)
+    return cv2.GaussianBlur(img, (5, 5), 0)
+
+
+def build_image_pool(size: int, seed: int, max_attempts: int = 2000) -> List[bytes]:
+    """JPEG-encoded synthetic faces, keeping only those the detector finds"""
+    import cv2
+
+    detect_faces = None
+    try:
+        sys.path.insert(0, FACE_DIR)
+        from face_utils import detect_faces
+    except ImportError:
+        pass
+
+    rng = np.random.default_rng(seed)
+    pool = []
+    for _ in range(max_attempts):
+        encoded = cv2.imencode(".jpg", synthetic_face(rng), [int(cv2.IMWRITE_JPEG_QUALITY), 90])[1]
+        # Check the decoded JPEG, which is what the service will see
+        if detect_faces is not None and len(detect_faces(cv2.imdecode(encoded, cv2.IMREAD_COLOR))) != 1:
+            continue
+        pool.append(encoded.tobytes())
+        if len(pool) >= size:
+            break
+    if not pool:
+        raise RuntimeError("Could not generate any detectable synthetic faces")
+    return pool
+
+
+def bust_cache(image: bytes, request_id: int) -> bytes:
+    """
+    Make the upload byte-unique without changing the decoded image
+
+    JPEG decoders ignore data after the end-of-image marker, so appending a
+    request counter defeats the content-hash result cache.
+    """
+    return image + f"loadtest-{request_id}".encode("ascii")
+
+
+def seed_face_documents(count: int, images: List[bytes], seed: int) -> List[Dict[str, Any]]:
+    """Gallery documents built from the synthetic faces with jittered encodings"""
+    import cv2
+    from datetime import datetime, timedelta
+    from face_utils import create_face_document, detect_faces, extract_face_encoding
+
+    rng = np.random.default_rng(seed)
+    crops = []
+    for image in images:
+        img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+        x, y, w, h = detect_faces(img)[0]
+        crop = img[y:y + h, x:x + w]
+        crops.append((crop, np.asarray(extract_face_encoding(crop))))
+
+    start = datetime.now() - timedelta(days=1)
+    documents = []
+    for i in range(count):
+        crop, encoding = crops[i % len(crops)]
+        jittered = encoding * (1 + 0.05 * rng.standard_normal(encoding.shape))
+        document = create_face_document(
+            f"person_{i}", crop, jittered.tolist(), {"department": f"team_{i % 7}"}
+        )
+        document["registration_timestamp"] = start + timedelta(seconds=i)
+        documents.append(document)
+    return documents
+
+
+# ---------------------------------------------------------------------------
+# Stubs for in-process runs
+# ---------------------------------------------------------------------------
+
+class StubGroqClient:
+    """Stands in for groq.Client; blocks like the real synchronous call does"""
+
+    def __init__(self, latency_ms: float = 0.0, **kwargs):
+        self.latency_ms = latency_ms
+        self.chat = self
+        self.completions = self
+
+    def create(self, model: str, messages: List[Dict[str, str]], **kwargs):
+        from types import SimpleNamespace
+
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        prompt = messages[-1]["content"]
+        content = f"Stub answer ({len(prompt)} prompt chars)"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=8)
+        )
+
+
+def hashing_embeddings(dim: int = 384):
+    """Deterministic bag-of-words embeddings, avoiding the model download"""
+    from langchain_core.embeddings import Embeddings
+
+    class HashingEmbeddings(Embeddings):
+        def _embed(self, text: str) -> List[float]:
+            vector = np.zeros(dim, dtype=np.float32)
+            for token in text.lower().split():
+                digest = hashlib.md5(token.encode("utf-8")).digest()
+                vector[int.from_bytes(digest[:4], "little") % dim] += 1.0
+            norm = np.linalg.norm(vector)
+            return (vector / norm if norm else vector).tolist()
+
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            return [self._embed(text) for text in texts]
+
+        def embed_query(self, text: str) -> List[float]:
+            return self._embed(text)
+
+    return HashingEmbeddings()
+
+
+class AppServers:
+    """Serves the apps with uvicorn on localhost, on an event loop of their own
+
+    The load generator keeps its own loop, so requests are timestamped when
+    they are sent and time spent queued behind a busy app counts as latency.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._servers = []
+        self._thread = threading.Thread(target=self.loop.run_forever, name="loadtest-apps", daemon=True)
+        self._thread.start()
+
+    async def serve(self, app) -> str:
+        """Start app on a free port and return its base URL once it is accepting"""
+        import uvicorn
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server = uvicorn.Server(uvicorn.Config(app, lifespan="on", log_level="warning"))
+        task = asyncio.wrap_future(asyncio.run_coroutine_threadsafe(server.serve(sockets=[sock]), self.loop))
+        while not server.started:
+            if task.done():
+                await task
+                raise RuntimeError(f"{app.title} failed to start")
+            await asyncio.sleep(0.01)
+        self._servers.append((server, task))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+    async def close(self) -> None:
+        for server, task in reversed(self._servers):
+            server.should_exit = True
+            await task
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        await asyncio.to_thread(self._thread.join)
+        self.loop.close()
+
+
+class HTTPWebSocket:
+    """WebSocket client with the few calls the ws driver needs"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._conn = None
+
+    async def connect(self) -> None:
+        import websockets
+
+        self._conn = await websockets.connect(self.url)
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        await self._conn.send(json.dumps(data))
+
+    async def receive_json(self) -> Dict[str, Any]:
+        return json.loads(await self._conn.recv())
+
+    async def close(self) -> None:
+        await self._conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Targets
+# ---------------------------------------------------------------------------
+
+class Target(abc.ABC):
+    """Clients for the face and RAG services, in-process or over HTTP"""
+
+    def __init__(self):
+        self.face_client = None
+        self.rag_client = None
+        self.images: List[bytes] = []
+        self.cache_busting = True
+        # Loop the apps run on, when it is in this process, for the lag monitor
+        self.app_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @abc.abstractmethod
+    async def start(self, endpoints: List[str]) -> None:
+        """Create the clients the selected endpoints need"""
+
+    @abc.abstractmethod
+    async def open_websocket(self):
+        """Connect to the RAG service's /ws endpoint"""
+
+    async def close(self) -> None:
+        for client in (self.face_client, self.rag_client):
+            if client is not None:
+                await client.aclose()
+
+
+class InProcessTarget(Target):
+    """Both FastAPI apps in this process, backed by mongomock and stubs"""
+
+    def __init__(self, args):
+        super().__init__()
+        self.args = args
+        self.servers = AppServers()
+        self.app_loop = self.servers.loop
+        self.rag_url = ""
+
+    async def start(self, endpoints: List[str]) -> None:
+        import httpx
+        import mongomock_motor
+
+        mongo = mongomock_motor.AsyncMongoMockClient()
+        database = mongo[os.getenv("DB_NAME", "face_recognition")]
+        self.images = build_image_pool(self.args.image_pool, self.args.seed)
+
+        sys.path.insert(0, FACE_DIR)
+        import db
+
+        db.client = mongo
+        db.db = database
+        db.face_collection = database.faces
+        db.tombstone_collection = database.face_tombstones
+        db.meta_collection = database.gallery_meta
+
+        async def create_indices():
+            # mongomock does not implement collation indexes
+            return None
+
+        db.create_indices = create_indices
+
+        documents = seed_face_documents(self.args.seed_faces, self.images, self.args.seed)
+        if documents:
+            await database.faces.insert_many(documents)
+
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        if {"register", "recognize"} & set(endpoints):
+            import app as face_app
+
+            face_url = await self.servers.serve(face_app.app)
+            self.face_client = httpx.AsyncClient(base_url=face_url, timeout=None, limits=limits)
+
+        if {"query", "ws"} & set(endpoints):
+            os.environ.setdefault("GROQ_API_KEY", "loadtest")
+            os.environ.setdefault("HF_API_KEY", "loadtest")
+            sys.path.insert(0, RAG_DIR)
+            import rag_fastapi
+
+            latency_ms = self.args.groq_latency_ms
+            rag_fastapi.groq.Client = lambda **kwargs: StubGroqClient(latency_ms)
+            rag_fastapi.AsyncIOMotorClient = lambda *a, **kw: mongo
+            if self.args.stub_embeddings:
+                rag_fastapi.create_embeddings = lambda *args, **kwargs: hashing_embeddings()
+
+            self.rag_url = await self.servers.serve(rag_fastapi.app)
+            self.rag_client = httpx.AsyncClient(base_url=self.rag_url, timeout=None, limits=limits)
+
+    async def open_websocket(self):
+        return HTTPWebSocket(_websocket_url(self.rag_url))
+
+    async def close(self) -> None:
+        await super().close()
+        await self.servers.close()
+
+
+class HTTPTarget(Target):
+    """Services already running, e.g. started with uvicorn on localhost"""
+
+    def __init__(self, args):
+        super().__init__()
+        self.args = args
+
+    async def start(self, endpoints: List[str]) -> None:
+        import httpx
+
+        self.images = build_image_pool(self.args.image_pool, self.args.seed)
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        self.face_client = httpx.AsyncClient(base_url=self.args.face_url, timeout=60, limits=limits)
+        self.rag_client = httpx.AsyncClient(base_url=self.args.rag_url, timeout=60, limits=limits)
+
+    async def open_websocket(self):
+        return HTTPWebSocket(_websocket_url(self.args.rag_url))
+
+
+def _websocket_url(base_url: str) -> str:
+    return base_url.replace("http", "ws", 1).rstrip("/") + "/ws"
+
+
+# ---------------------------------------------------------------------------
+# Request drivers
+# ---------------------------------------------------------------------------
+
+def _image(target: Target, request_id: int) -> bytes:
+    image = target.images[request_id % len(target.images)]
+    return bust_cache(image, request_id) if target.cache_busting else image
+
+
+async def register_request(target: Target, request_id: int, state: Dict[str, Any]) -> bool:
+    response = await target.face_client.post(
+        "/register-face",
+        data={"name": f"loadtest_{request_id}", "similarity_threshold": "1.01"},
+        files={"image": ("face.jpg", _image(target, request_id), "image/jpeg")}
+    )
+    return response.status_code < 400
+
+
+async def recognize_request(target: Target, request_id: int, state: Dict[str, Any]) -> bool:
+    response = await target.face_client.post(
+        "/recognize-face",
+        data={"similarity_threshold": "0.65", "max_results": "5"},
+        files={"image": ("face.jpg", _image(target, request_id), "image/jpeg")}
+    )
+    return response.status_code < 400
+
+
+async def query_request(target: Target, request_id: int, state: Dict[str, Any]) -> bool:
+    response = await target.rag_client.post(
+        "/query", json={"message": QUESTIONS[request_id % len(QUESTIONS)]}
+    )
+    return response.status_code < 400
+
+
+async def ws_request(target: Target, request_id: int, state: Dict[str, Any]) -> bool:
+    # One connection per virtual user, opened on first use
+    websocket = state.get("websocket")
+    if websocket is None:
+        websocket = await target.open_websocket()
+        await websocket.connect()
+        await websocket.receive_json()  # greeting
+        state["websocket"] = websocket
+
+    await websocket.send_json({"message": QUESTIONS[request_id % len(QUESTIONS)]})
+    while True:
+        message = await websocket.receive_json()
+        if message["type"] == "answer":
+            return True
+        if message["type"] == "error":
+            return False
+
+
+ENDPOINTS: Dict[str, Callable[[Target, int, Dict[str, Any]], Awaitable[bool]]] = {
+    "register": register_request,
+    "recognize": recognize_request,
+    "query": query_request,
+    "ws": ws_request,
+}
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up a periodic timer
+
+    With a loop given, the timer runs there (the apps' loop in-process runs)
+    instead of on the caller's loop.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, interval: float = 0.01):
+        self.loop = loop
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+        self._sleep_started: Optional[float] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._sleep_started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - self._sleep_started - self.interval))
+
+    async def _on_loop(self, coro):
+        if self.loop is None:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def start(self) -> None:
+        await self._on_loop(self._start())
+
+    async def stop(self) -> List[float]:
+        return await self._on_loop(self._stop())
+
+    async def _start(self) -> None:
+        self.samples = []
+        self._sleep_started = None
+        self._task = asyncio.create_task(self._run())
+
+    async def _stop(self) -> List[float]:
+        # A timer still pending when the run ends counts too; a loop that never
+        # became idle would otherwise report no lag at all
+        if self._sleep_started is not None:
+            overdue = asyncio.get_running_loop().time() - self._sleep_started - self.interval
+            if overdue > 0:
+                self.samples.append(overdue)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return self.samples
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+async def run_level(target: Target, endpoint: str, concurrency: int, total_requests: int,
+                    request_offset: int) -> Dict[str, Any]:
+    """Drive one endpoint with `concurrency` virtual users until total_requests finish"""
+    driver = ENDPOINTS[endpoint]
+    latencies: List[float] = []
+    errors = 0
+    next_request = 0
+    monitor = LoopLagMonitor(target.app_loop)
+
+    async def user():
+        nonlocal next_request, errors
+        state: Dict[str, Any] = {}
+        try:
+            while next_request < total_requests:
+                request_id = request_offset + next_request
+                next_request += 1
+                start = time.perf_counter()
+                try:
+                    ok = await driver(target, request_id, state)
+                except Exception:
+                    ok = False
+                    state.pop("websocket", None)
+                latencies.append(time.perf_counter() - start)
+                if not ok:
+                    errors += 1
+        finally:
+            websocket = state.get("websocket")
+            if websocket is not None:
+                try:
+                    await websocket.close()
+                except Exception:
+                    pass
+
+    await monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    lag = await monitor.stop()
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    lag_ms = [sample * 1000 for sample in lag]
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies_ms, 50),
+        "p95_ms": _percentile(latencies_ms, 95),
+        "p99_ms": _percentile(latencies_ms, 99),
+        "error_rate": errors / len(latencies) if latencies else 0.0,
+        "loop_lag_p99_ms": _percentile(lag_ms, 99),
+        "loop_lag_max_ms": max(lag_ms) if lag_ms else 0.0,
+    }
+
+
+def print_report(rows: List[Dict[str, Any]]) -> None:
+    header = (f"{'endpoint':<10}{'conc':>6}{'reqs':>7}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}"
+              f"{'p99 ms':>10}{'err %':>8}{'lag p99':>10}{'lag max':>10}")
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(f"{row['endpoint']:<10}{row['concurrency']:>6}{row['requests']:>7}"
+              f"{row['throughput_rps']:>9.1f}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['error_rate'] * 100:>8.1f}"
+              f"{row['loop_lag_p99_ms']:>10.1f}{row['loop_lag_max_ms']:>10.1f}")
+
+
+async def main_async(args) -> List[Dict[str, Any]]:
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(",") if endpoint.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        raise SystemExit(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    target = InProcessTarget(args) if args.mode == "inprocess" else HTTPTarget(args)
+    target.cache_busting = not args.allow_cache_hits
+    await target.start(endpoints)
+
+    rows = []
+    request_offset = 0
+    try:
+        for endpoint in endpoints:
+            if args.warmup:
+                await run_level(target, endpoint, 1, args.warmup, request_offset)
+                request_offset += args.warmup
+            for concurrency in levels:
+                total = args.requests or concurrency * args.requests_per_user
+                rows.append(await run_level(target, endpoint, concurrency, total, request_offset))
+                request_offset += total
+    finally:
+        await target.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load generator and SLO report for the face recognition and RAG APIs"
+    )
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess",
+                        help="Serve the apps from this process (mock Mongo, stub Groq) or use running ones")
+    parser.add_argument("--endpoints", default="recognize,register,query,ws",
+                        help="Comma-separated subset of: " + ", ".join(ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,4,16,32",
+                        help="Comma-separated concurrency levels to sweep")
+    parser.add_argument("--requests", type=int, default=0,
+                        help="Requests per level (default: concurrency * --requests-per-user)")
+    parser.add_argument("--requests-per-user", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured requests per endpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--seed-faces", type=int, default=200,
+                        help="Gallery size seeded into the mock Mongo (in-process)")
+    parser.add_argument("--image-pool", type=int, default=16, help="Distinct synthetic faces")
+    parser.add_argument("--allow-cache-hits", action="store_true",
+                        help="Send byte-identical images so the result cache can hit")
+    parser.add_argument("--groq-latency-ms", type=float, default=0.0,
+                        help="Simulated latency of the stub Groq call (in-process)")
+    parser.add_argument("--stub-embeddings", action="store_true",
+                        help="Use hashing embeddings instead of all-MiniLM-L6-v2 (in-process)")
+    parser.add_argument("--face-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--rag-url", default="http://127.0.0.1:8001")
+    parser.add_argument("--json", help="Also write the report rows to this JSON file")
+    args = parser.parse_args()
+
+    rows = asyncio.run(main_async(args))
+    print_report(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Tuple
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+# Document builder configuration
+# Comma-separated additional_info keys to index; other keys stay out of the
+# knowledge base unless the list is "*", which indexes every scalar field
+RAG_INFO_FIELDS = [
+    key.strip()
+    for key in os.getenv("RAG_INFO_FIELDS", "role,title,department,organization,team,location").split(",")
+    if key.strip()
+]
+RAG_MAX_INFO_FIELDS = int(os.getenv("RAG_MAX_INFO_FIELDS", "5"))
+RAG_FIELD_MAX_CHARS = int(os.getenv("RAG_FIELD_MAX_CHARS", "200"))
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "400"))
+RAG_RETRIEVE_K = int(os.getenv("RAG_RETRIEVE_K", "4"))
+
+# Only these fields are read from face documents; images and encodings never leave Mongo
+DOCUMENT_PROJECTION = {
+    "name": 1,
+    "registration_time": 1,
+    "registration_timestamp": 1,
+    "additional_info": 1,
+}
+
+# Values that can be rendered as text in a chunk
+_SCALAR_TYPES = (str, int, float, bool, datetime)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, about four characters per token for English text"""
+    return (len(text) + 3) // 4
+
+
+def _clip(value: Any, max_chars: int = RAG_FIELD_MAX_CHARS) -> str:
+    text = " ".join(str(value).split())
+    return text if len(text) <= max_chars else text[:max_chars - 3].rstrip() + "..."
+
+
+def _info_fields(additional_info: Any) -> List[Tuple[str, str]]:
+    """Allowlisted, length-capped (key, value) pairs from additional_info"""
+    if not isinstance(additional_info, dict):
+        return []
+
+    keys = sorted(additional_info) if RAG_INFO_FIELDS == ["*"] else RAG_INFO_FIELDS
+    fields = []
+    for key in keys:
+        value = additional_info.get(key)
+        if value is None or value == "" or not isinstance(value, _SCALAR_TYPES):
+            continue
+        fields.append((_clip(key, 40), _clip(value)))
+        if len(fields) >= RAG_MAX_INFO_FIELDS:
+            break
+    return fields
+
+
+def build_documents(face: Dict[str, Any]) -> List[Document]:
+    """
+    Text chunks for one face document
+
+    Returns:
+        A basic info chunk and, when the face has allowlisted fields, an
+        additional info chunk. Empty if the face has no registration time.
+    """
+    registration_time = face.get("registration_time") or face.get("registration_timestamp")
+    if not registration_time:
+        logger.warning(f"Face {face.get('_id')} has no registration time, skipping...")
+        return []
+
+    face_id = str(face["_id"])
+    name = _clip(face.get("name") or "Unknown", 100)
+    documents = [Document(
+        page_content=f"Name: {name}\nRegistered: {registration_time}",
+        metadata={
+            "id": face_id,
+            "name": name,
+            "registration_time": registration_time,
+            "chunk_type": "basic_info"
+        }
+    )]
+
+    fields = _info_fields(face.get("additional_info"))
+    if fields:
+        documents.append(Document(
+            page_content=f"Additional Info for {name}:\n" + "\n".join(f"{key}: {value}" for key, value in fields),
+            metadata={
+                "id": face_id,
+                "name": name,
+                "chunk_type": "additional_info"
+            }
+        ))
+    return documents
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Embeddings of chunk texts keyed by content hash
+
+    Rebuilding the knowledge base only embeds chunks whose text is new;
+    unchanged and duplicate chunks reuse the stored vectors.
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self._vectors: Dict[str, List[float]] = {}
+        self.last_embedded = 0
+        self.last_reused = 0
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        hashes = [content_hash(text) for text in texts]
+        missing = {}
+        for text, digest in zip(texts, hashes):
+            if digest not in self._vectors:
+                missing.setdefault(digest, text)
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self._vectors.update(zip(missing.keys(), vectors))
+
+        # Drop vectors for chunks that no longer exist
+        live = set(hashes)
+        self._vectors = {digest: vector for digest, vector in self._vectors.items() if digest in live}
+
+        self.last_embedded = len(missing)
+        self.last_reused = len(texts) - len(missing)
+        return [self._vectors[digest] for digest in hashes]
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+
+def assemble_context(docs: Iterable[Document], max_tokens: int = RAG_CONTEXT_TOKENS) -> Tuple[str, List[Document]]:
+    """
+    Join retrieved chunks into a prompt context within a token budget
+
+    Chunks are grouped by face in retrieval order, basic info first. Faces
+    are added whole until the next one would exceed the budget; the first
+    face is always included so the answer has something to work from.
+
+    Returns:
+        (context text, documents that made it into the context)
+    """
+    faces: Dict[str, List[Document]] = {}
+    for doc in docs:
+        faces.setdefault(doc.metadata.get("id"), []).append(doc)
+
+    parts: List[str] = []
+    used: List[Document] = []
+    tokens = 0
+    separator_tokens = estimate_tokens("\n---\n")
+    for chunks in faces.values():
+        chunks.sort(key=lambda chunk: chunk.metadata.get("chunk_type") != "basic_info")
+        text = "\n".join(chunk.page_content for chunk in chunks)
+        cost = estimate_tokens(text) + (separator_tokens if parts else 0)
+        if parts and tokens + cost > max_tokens:
+            break
+        parts.append(text)
+        used.extend(chunks)
+        tokens += cost
+    return "\n---\n".join(parts), used
@@ -0,0 +1,377 @@
+import argparse
+import asyncio
+import inspect
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Embedding backend configuration
+RAG_EMBEDDING_BACKEND = os.getenv("RAG_EMBEDDING_BACKEND", "huggingface")
+RAG_EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+RAG_EMBEDDING_THREADS = int(os.getenv("RAG_EMBEDDING_THREADS", "0"))
+RAG_EMBEDDING_BATCH_SIZE = int(os.getenv("RAG_EMBEDDING_BATCH_SIZE", "32"))
+RAG_ONNX_MODEL_DIR = os.getenv("RAG_ONNX_MODEL_DIR", "onnx_model")
+RAG_ONNX_QUANTIZED = os.getenv("RAG_ONNX_QUANTIZED", "true").lower() == "true"
+RAG_QUERY_BATCH_SIZE = int(os.getenv("RAG_QUERY_BATCH_SIZE", "16"))
+RAG_QUERY_BATCH_WAIT_MS = float(os.getenv("RAG_QUERY_BATCH_WAIT_MS", "2"))
+
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model_int8.onnx"
+MAX_SEQUENCE_LENGTH = 256
+
+
+def current_threads() -> int:
+    """torch's intra-op thread count, or 0 when torch is not installed"""
+    try:
+        import torch
+    except ImportError:
+        return 0
+    return torch.get_num_threads()
+
+
+def configure_threads(threads: int = RAG_EMBEDDING_THREADS) -> None:
+    """Set the intra-op thread count for torch; 0 keeps the library default"""
+    if threads <= 0:
+        return
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+
+def _hub_name(model_name: str) -> str:
+    if os.path.isdir(model_name) or "/" in model_name:
+        return model_name
+    return f"sentence-transformers/{model_name}"
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence embeddings from an exported ONNX encoder on the CPU runtime
+
+    Mean pooling over the attention mask followed by L2 normalization,
+    matching what sentence-transformers does for all-MiniLM-L6-v2.
+    """
+
+    def __init__(self, model_dir: str = RAG_ONNX_MODEL_DIR, quantized: bool = RAG_ONNX_QUANTIZED,
+                 threads: int = RAG_EMBEDDING_THREADS, batch_size: int = RAG_EMBEDDING_BATCH_SIZE):
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("The onnx embedding backend needs onnxruntime and transformers installed") from e
+
+        path = os.path.join(model_dir, ONNX_INT8_FILE if quantized else ONNX_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found; run `python embedding_backend.py export` first")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.batch_size = batch_size
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + self.batch_size], padding=True, truncation=True,
+                max_length=MAX_SEQUENCE_LENGTH, return_tensors="np"
+            )
+            feeds = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+
+def export_onnx(model_name: str = RAG_EMBEDDING_MODEL, out_dir: str = RAG_ONNX_MODEL_DIR,
+                quantize: bool = True) -> str:
+    """
+    Export the transformer encoder to ONNX, plus a dynamically int8-quantized copy
+
+    Returns:
+        Path of the model the onnx backend will load by default
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(_hub_name(model_name))
+    model = AutoModel.from_pretrained(_hub_name(model_name)).eval()
+    tokenizer.save_pretrained(out_dir)
+
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    input_names = list(sample)
+
+    class Encoder(torch.nn.Module):
+        """Positional inputs in tokenizer order, last hidden state out"""
+
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    # Newer torch defaults to the dynamo exporter; keep the TorchScript one
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    path = os.path.join(out_dir, ONNX_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            Encoder(), tuple(sample[name] for name in input_names), path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+            **export_kwargs
+        )
+
+    if not quantize:
+        return path
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    int8_path = os.path.join(out_dir, ONNX_INT8_FILE)
+    quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+def create_embeddings(backend: str = RAG_EMBEDDING_BACKEND, model_name: str = RAG_EMBEDDING_MODEL,
+                      threads: int = RAG_EMBEDDING_THREADS, **kwargs) -> Embeddings:
+    """
+    Embedding model for the configured backend
+
+    - huggingface: sentence-transformers on torch, the original setup
+    - onnx: exported encoder on onnxruntime, int8 unless RAG_ONNX_QUANTIZED=false
+    """
+    configure_threads(threads)
+    if backend == "onnx":
+        return OnnxEmbeddings(threads=threads, **kwargs)
+    if backend == "huggingface":
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        return HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs={'device': 'cpu'},
+            encode_kwargs={'normalize_embeddings': True, 'batch_size': RAG_EMBEDDING_BATCH_SIZE}
+        )
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+
+class MicroBatcher:
+    """
+    Merges concurrent query embeddings into one forward pass
+
+    The first query waits up to max_wait_ms for others to join its batch;
+    the batch runs in the default executor so the event loop stays free.
+    """
+
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]],
+                 max_batch: int = RAG_QUERY_BATCH_SIZE, max_wait_ms: float = RAG_QUERY_BATCH_WAIT_MS):
+        self.embed_batch = embed_batch
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.items = 0
+
+    async def embed(self, text: str) -> List[float]:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                vectors = await loop.run_in_executor(None, self.embed_batch, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "queries": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+
+def _top_k(documents: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    scores = queries @ documents.T
+    k = min(k, documents.shape[0])
+    return [set(np.argpartition(-row, k - 1)[:k].tolist()) for row in scores]
+
+
+def compare(texts: List[str], queries: List[str], backends: Dict[str, Tuple[Embeddings, int]],
+            k: int = 4, concurrency: int = 16) -> List[Dict[str, Any]]:
+    """
+    Throughput and retrieval agreement of each backend against the first one
+
+    Backends map a label to (embeddings, torch intra-op threads). Agreement
+    is the mean overlap of top-k documents per query with the baseline
+    backend's top-k.
+    """
+    results = []
+    baseline = None
+    for name, (embeddings, threads) in backends.items():
+        configure_threads(threads)
+        embeddings.embed_documents(texts[:8])  # warm up
+
+        start = time.perf_counter()
+        documents = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        index_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        query_vectors = np.asarray([embeddings.embed_query(query) for query in queries], dtype=np.float32)
+        sequential_seconds = time.perf_counter() - start
+
+        async def batched():
+            batcher = MicroBatcher(embeddings.embed_documents)
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def one(query):
+                async with semaphore:
+                    return await batcher.embed(query)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one(query) for query in queries))
+            return time.perf_counter() - start, batcher.stats()
+
+        batched_seconds, batch_stats = asyncio.run(batched())
+
+        top = _top_k(documents, query_vectors, k)
+        if baseline is None:
+            baseline = top
+        agreement = np.mean([len(a & b) / len(b) for a, b in zip(top, baseline)]) if top else 0.0
+
+        results.append({
+            "backend": name,
+            "index_docs_per_s": len(texts) / index_seconds,
+            "queries_per_s": len(queries) / sequential_seconds,
+            "batched_queries_per_s": len(queries) / batched_seconds,
+            "mean_batch_size": batch_stats["mean_batch_size"],
+            "top_k_agreement": float(agreement),
+        })
+    return results
+
+
+def _synthetic_corpus(count: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    teams = ["research", "sales", "support", "platform", "design", "finance", "legal"]
+    texts, queries = [], []
+    for i in range(count):
+        team = teams[i % len(teams)]
+        texts.append(f"Name: person_{i}\nRegistered: 2025-01-{1 + i % 28:02d} 10:{i % 60:02d}:00")
+        texts.append(f"Additional Info for person_{i}:\ndepartment: {team}\nrole: engineer level {i % 5}")
+    for i in rng.choice(count, size=min(count, 200), replace=False):
+        queries.append(f"When was person_{i} registered and which team are they in?")
+    return texts, queries
+
+
+async def _load_corpus():
+    from document_builder import DOCUMENT_PROJECTION, build_documents
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(os.getenv("MONGO_URL"))
+    faces = await client[os.getenv("DB_NAME", "face_recognition")].faces.find({}, DOCUMENT_PROJECTION).to_list(length=None)
+    documents = [doc for face in faces for doc in build_documents(face)]
+    texts = [doc.page_content for doc in documents]
+    queries = [f"Who is {doc.metadata['name']} and when did they register?" for doc in documents[:200:2]]
+    return texts, queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding backend tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export the model to ONNX (fp32 and int8)")
+    export_parser.add_argument("--model", default=RAG_EMBEDDING_MODEL)
+    export_parser.add_argument("--out", default=RAG_ONNX_MODEL_DIR)
+    export_parser.add_argument("--no-quantize", action="store_true")
+
+    compare_parser = subparsers.add_parser("compare", help="Benchmark backends against the current setup")
+    compare_parser.add_argument("--model", default=RAG_EMBEDDING_MODEL)
+    compare_parser.add_argument("--onnx-dir", default=RAG_ONNX_MODEL_DIR)
+    compare_parser.add_argument("--synthetic", type=int, default=0,
+                                help="Use N synthetic faces instead of the stored gallery")
+    compare_parser.add_argument("--threads", type=int, default=0,
+                                help="Intra-op threads for the tuned variants")
+    compare_parser.add_argument("--k", type=int, default=4)
+    compare_parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        print(f"Exported {export_onnx(args.model, args.out, not args.no_quantize)}")
+        return
+
+    texts, queries = _synthetic_corpus(args.synthetic) if args.synthetic else asyncio.run(_load_corpus())
+
+    # Baseline first: the original HuggingFaceEmbeddings setup with default threads
+    huggingface = create_embeddings("huggingface", args.model, threads=0)
+    backends = {"huggingface": (huggingface, current_threads())}
+    if args.threads > 0:
+        backends[f"huggingface threads={args.threads}"] = (huggingface, args.threads)
+    for quantized in (False, True):
+        path = os.path.join(args.onnx_dir, ONNX_INT8_FILE if quantized else ONNX_FILE)
+        if os.path.exists(path):
+            name = f"onnx {'int8' if quantized else 'fp32'}"
+            backends[name] = (OnnxEmbeddings(args.onnx_dir, quantized=quantized, threads=args.threads), 0)
+
+    print(f"{len(texts)} documents, {len(queries)} queries")
+    for row in compare(texts, queries, backends, args.k, args.concurrency):
+        print(f"{row['backend']:>26}: index {row['index_docs_per_s']:8.1f} docs/s | "
+              f"query {row['queries_per_s']:7.1f}/s | batched {row['batched_queries_per_s']:7.1f}/s "
+              f"(mean batch {row['mean_batch_size']:.1f}) | top-{args.k} agreement {row['top_k_agreement']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,18 +11,28 @@ import signal
 import sys
 
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
 from dotenv import load_dotenv
 import groq
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_text_splitters import CharacterTextSplitter
 from langchain_community.vectorstores import FAISS
-from langchain_core.documents import Document
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
 
+from document_builder import (
+    DOCUMENT_PROJECTION,
+    RAG_CONTEXT_TOKENS,
+    RAG_RETRIEVE_K,
+    EmbeddingStore,
+    assemble_context,
+    build_documents,
+    estimate_tokens
+)
+from embedding_backend import RAG_EMBEDDING_BACKEND, MicroBatcher, create_embeddings
+
 # Suppress FAISS GPU warning
 warnings.filterwarnings("ignore", message="Failed to load GPU Faiss")
 
@@ -41,6 +51,17 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 HF_API_KEY = os.getenv("HF_API_KEY")
 MONGO_CONNECTION_STRING = os.getenv("MONGO_URL")
 DB_NAME = os.getenv("DB_NAME", "face_recognition")
+USE_GALLERY_CACHE = os.getenv("USE_GALLERY_CACHE", "false").lower() == "true"
+RAG_GALLERY_CACHE_PATH = os.getenv("RAG_GALLERY_CACHE_PATH", "rag_gallery_cache.sqlite3")
+USE_PROFILING = os.getenv("USE_PROFILING", "false").lower() == "true"
+
+if USE_GALLERY_CACHE or USE_PROFILING:
+    # The gallery cache and profiler are shared with the face recognition service
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "face_recognition"))
+if USE_GALLERY_CACHE:
+    from gallery_cache import GalleryCache
+if USE_PROFILING:
+    from profiling import ProfilingMiddleware
 
 if not GROQ_API_KEY or not HF_API_KEY:
     raise ValueError("Both GROQ_API_KEY and HF_API_KEY environment variables are required")
@@ -56,6 +77,10 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Opt-in sampling profiler for requests sent with the X-Profile token or sampled by rate
+if USE_PROFILING:
+    app.add_middleware(ProfilingMiddleware)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -92,11 +117,11 @@ class RAGEngine:
         """Initialize LLM and embeddings models"""
         try:
             self.llm = groq.Client(api_key=GROQ_API_KEY)
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name="all-MiniLM-L6-v2",
-                model_kwargs={'device': 'cpu'},
-                encode_kwargs={'normalize_embeddings': True}
-            )
+            self.embeddings = create_embeddings()
+            # Concurrent queries share one forward pass off the event loop
+            self.query_batcher = MicroBatcher(self.embeddings.embed_documents)
+            logger.info(f"Embedding backend: {RAG_EMBEDDING_BACKEND}")
+            self.embedding_store = EmbeddingStore(self.embeddings)
         except Exception as e:
             logger.error(f"Error setting up models: {str(e)}")
             raise
@@ -108,6 +133,8 @@ class RAGEngine:
             self.client = AsyncIOMotorClient(MONGO_CONNECTION_STRING)
             self.db = self.client[DB_NAME]
             self.faces_collection = self.db.faces
+            self.tombstone_collection = self.db.face_tombstones
+            self.gallery_cache = GalleryCache(RAG_GALLERY_CACHE_PATH) if USE_GALLERY_CACHE else None
             logger.info("Database connection established successfully")
         except Exception as e:
             logger.error(f"Error setting up database: {str(e)}")
@@ -116,7 +143,13 @@ class RAGEngine:
     async def _get_faces_from_db(self):
         """Fetch faces from database"""
         try:
-            cursor = self.faces_collection.find()
+            if self.gallery_cache is not None:
+                # Load from disk and pull only changes since the last sync
+                changes = await self.gallery_cache.sync(self.faces_collection, self.tombstone_collection)
+                logger.info(f"Gallery cache synced: {changes}")
+                return self.gallery_cache.faces()
+
+            cursor = self.faces_collection.find({}, DOCUMENT_PROJECTION)
             faces = await cursor.to_list(length=1000)  # Limit to 1000 faces for performance
             return faces
         except Exception as e:
@@ -129,49 +162,11 @@ class RAGEngine:
             # Get faces from database
             faces = await self._get_faces_from_db()
             
-            # Convert faces to documents with smaller chunks
+            # Convert faces to small chunks of allowlisted, length-capped fields
             documents = []
             for face in faces:
                 try:
-                    # Get registration time from either registration_time or registration_timestamp
-                    registration_time = face.get('registration_time') or face.get('registration_timestamp')
-                    if not registration_time:
-                        logger.warning(f"Face {face.get('_id')} has no registration time, skipping...")
-                        continue
-
-                    # Create smaller, focused chunks for each face
-                    # Basic info chunk - keep it minimal
-                    basic_info = (
-                        f"Name: {face.get('name', 'Unknown')}\n"
-                        f"Registered: {registration_time}"
-                    )
-                    documents.append(Document(
-                        page_content=basic_info,
-                        metadata={
-                            "id": str(face["_id"]),
-                            "name": face.get('name', 'Unknown'),
-                            "registration_time": registration_time,
-                            "chunk_type": "basic_info"
-                        }
-                    ))
-
-                    # Additional info chunk (if any) - limit to essential fields
-                    additional_info = []
-                    for key, value in face.items():
-                        if key not in ['_id', 'name', 'registration_time', 'registration_timestamp', 'face_encoding']:
-                            additional_info.append(f"{key}: {value}")
-                    
-                    if additional_info:
-                        info_chunk = f"Additional Info for {face.get('name', 'Unknown')}:\n" + "\n".join(additional_info[:3])  # Limit to 3 additional fields
-                        documents.append(Document(
-                            page_content=info_chunk,
-                            metadata={
-                                "id": str(face["_id"]),
-                                "name": face.get('name', 'Unknown'),
-                                "chunk_type": "additional_info"
-                            }
-                        ))
-
+                    documents.extend(build_documents(face))
                 except Exception as e:
                     logger.error(f"Error processing face document: {str(e)}")
                     continue
@@ -180,13 +175,19 @@ class RAGEngine:
                 logger.warning("No valid face documents found in the database")
                 return
 
-            # Create vector store with smaller chunks
-            self.vector_store = FAISS.from_documents(
-                documents, 
+            # Only chunks whose text changed since the last build are embedded
+            texts = [doc.page_content for doc in documents]
+            vectors = self.embedding_store.embed(texts)
+            self.vector_store = FAISS.from_embeddings(
+                list(zip(texts, vectors)),
                 self.embeddings,
+                metadatas=[doc.metadata for doc in documents],
                 normalize_L2=True
             )
-            logger.info(f"Knowledge base created successfully with {len(documents)} chunks")
+            logger.info(
+                f"Knowledge base created successfully with {len(documents)} chunks "
+                f"({self.embedding_store.last_embedded} embedded, {self.embedding_store.last_reused} reused)"
+            )
         except Exception as e:
             logger.error(f"Error creating knowledge base: {str(e)}")
             raise
@@ -197,30 +198,10 @@ class RAGEngine:
             if not query.strip():
                 raise ValueError("Query cannot be empty")
 
-            # Retrieve relevant chunks with a smaller k value
-            docs = self.vector_store.similarity_search(query, k=2)
-            
-            # Group chunks by face ID
-            face_chunks = {}
-            for doc in docs:
-                face_id = doc.metadata.get('id')
-                if face_id not in face_chunks:
-                    face_chunks[face_id] = []
-                face_chunks[face_id].append(doc)
-
-            # Format context more concisely
-            context_parts = []
-            for face_id, chunks in face_chunks.items():
-                # Combine chunks for the same face
-                face_info = []
-                for chunk in chunks:
-                    if chunk.metadata.get('chunk_type') == 'basic_info':
-                        face_info.insert(0, chunk.page_content)  # Put basic info first
-                    else:
-                        face_info.append(chunk.page_content)
-                context_parts.append("\n".join(face_info))
-            
-            context = "\n---\n".join(context_parts)
+            # Retrieve candidate chunks, then keep whole faces within the token budget
+            query_vector = await self.query_batcher.embed(query)
+            retrieved = self.vector_store.similarity_search_by_vector(query_vector, k=RAG_RETRIEVE_K)
+            context, docs = assemble_context(retrieved, RAG_CONTEXT_TOKENS)
 
             # Prepare chat history (limit to last 1 exchange)
             recent_history = list(self.chat_history)[-1:] if self.chat_history else []
@@ -247,7 +228,10 @@ Query: {query}
 Assistant: [/INST]"""
 
             # Get response from Groq
-            logger.info(f"Sending prompt to Groq (length: {len(formatted_prompt)})")
+            logger.info(
+                f"Sending prompt to Groq (length: {len(formatted_prompt)}, "
+                f"~{estimate_tokens(formatted_prompt)} tokens, {len(docs)}/{len(retrieved)} chunks)"
+            )
             
             try:
                 response = self.llm.chat.completions.create(
@@ -345,6 +329,24 @@ async def query(request: QueryRequest):
     result = await rag_engine.process_query(request.message)
     return QueryResponse(**result)
 
+@app.get("/embedding-stats")
+async def embedding_stats():
+    """Query micro-batching and index embedding reuse"""
+    if rag_engine is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="RAG engine is not initialized"
+        )
+    return {
+        "backend": RAG_EMBEDDING_BACKEND,
+        "query_batching": rag_engine.query_batcher.stats(),
+        "index": {
+            "stored_vectors": len(rag_engine.embedding_store),
+            "last_embedded": rag_engine.embedding_store.last_embedded,
+            "last_reused": rag_engine.embedding_store.last_reused
+        }
+    }
+
 @app.post("/refresh")
 async def refresh_data():
     """Refresh the knowledge base"""
@@ -417,9 +419,12 @@ async def websocket_endpoint(websocket: WebSocket):
                 await websocket.send_json({
                     "type": "answer",
                     "message": result["answer"],
-                    "sources": result["sources"]
+                    # Source metadata carries datetimes
+                    "sources": jsonable_encoder(result["sources"])
                 })
                 
+            except WebSocketDisconnect:
+                raise
             except json.JSONDecodeError:
                 await websocket.send_json({
                     "type": "error",
@@ -6,6 +6,10 @@ import "dotenv/config";
 
 const router = express.Router();
 
+// Proxy timeout; the Python side is told to give up slightly earlier
+const REQUEST_TIMEOUT_MS = 30000;
+const DEADLINE_MARGIN_MS = 1000;
+
 // Basic multer setup for multipart form data
 const upload = multer({
   storage: multer.memoryStorage() // Use memory storage to avoid file system operations
@@ -54,9 +58,10 @@ router.post('/', upload.single('image'), async (req, res) => {
     console.log('Sending request to Python server for face recognition...');
     const response = await axios.post(pythonServerUrl, formData, {
       headers: {
-        ...formData.getHeaders()
+        ...formData.getHeaders(),
+        'X-Request-Deadline-Ms': String(REQUEST_TIMEOUT_MS - DEADLINE_MARGIN_MS)
       },
-      timeout: 30000 // 30 second timeout for processing multiple faces
+      timeout: REQUEST_TIMEOUT_MS // 30 second timeout for processing multiple faces
     });
     
     console.log(`Received response: ${response.data.total_faces_detected} faces detected`);
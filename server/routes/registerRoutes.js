@@ -6,6 +6,10 @@ import "dotenv/config";
 
 const router = express.Router();
 
+// Proxy timeout; the Python side is told to give up slightly earlier
+const REQUEST_TIMEOUT_MS = 30000;
+const DEADLINE_MARGIN_MS = 1000;
+
 // Basic multer setup for multipart form data
 const upload = multer({
   storage: multer.memoryStorage() // Use memory storage to avoid file system operations
@@ -39,8 +43,10 @@ router.post('/', upload.single('image'), async (req, res) => {
     // Forward to Python server
     const response = await axios.post(pythonServerUrl, formData, {
       headers: {
-        ...formData.getHeaders()
+        ...formData.getHeaders(),
+        'X-Request-Deadline-Ms': String(REQUEST_TIMEOUT_MS - DEADLINE_MARGIN_MS)
       },
+      timeout: REQUEST_TIMEOUT_MS,
       maxContentLength: Infinity,
       maxBodyLength: Infinity
     });